@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Grammar pattern statistics from a corpus run with per-pattern
+# profiling, and advice on pattern order:
+#
+#   mparser.py -l files.txt --profile profile.json --profile-patterns
+#   pattern-report.py profile.json
+#
+# For every grammar section lists attempts, matches, analyses produced,
+# time, words matched and words where the analyses survived return if
+# parsed, then the patterns that never fired. For firstmatch sections
+# suggests the order that tries frequent patterns first while keeping
+# the first match of every hypothesis seen in the corpus (other texts
+# may need the grammar order). parallel and sequential sections try all
+# patterns anyway, their order only decides the order of analyses.
+
+import sys
+import json
+
+
+def percent(part, whole):
+    return '{0:.0f}%'.format(100.0 * part / whole) if whole else '-'
+
+def print_section(sec, out):
+    title = u'{section} ({combinator} {func})'.format(**sec)
+    out.write(u'\n{0}\n{1}\n'.format(title, '=' * len(title)).encode('utf-8'))
+    out.write('{0:>4} {1:>9} {2:>8} {3:>8} {4:>9} {5:>7} {6:>8} {7:>8}  pattern\n'.format(
+        '#', 'attempts', 'matches', 'produced', 'seconds', 'words', 'survived', 'wasted'))
+    for p in sec['patterns']:
+        out.write(u'{index:>4} {attempts:>9} {matches:>8} {produced:>8} {seconds:>9.3f} {words:>7} {survived:>8} {0:>8}  {pattern}\n'.format(
+            percent(p['words'] - p['survived'], p['words']), **p).encode('utf-8'))
+    never = [sec['patterns'][i] for i in sec['never']]
+    if never:
+        cost = sum(p['seconds'] for p in never)
+        out.write('never fired: {0} of {1} patterns, {2} attempts, {3:.3f}s\n'.format(
+            len(never), len(sec['patterns']), sum(p['attempts'] for p in never), cost))
+    if sec['combinator'] == 'firstmatch':
+        if sec['suggested_order'] != sorted(sec['suggested_order']):
+            out.write('suggested order: {0}, attempts {1} -> {2}\n'.format(
+                ' '.join(str(i) for i in sec['suggested_order']), sec['attempts'], sec['suggested_attempts']))
+        else:
+            out.write('grammar order is best, attempts {0}\n'.format(sec['attempts']))
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit('usage: pattern-report.py profile.json')
+    with open(sys.argv[1]) as f:
+        profile = json.load(f)
+    if 'patterns' not in profile:
+        sys.exit('No pattern statistics, run mparser.py with --profile-patterns')
+    out = sys.stdout
+    out.write('{0} words, {1:.3f}s\n'.format(profile['words'], profile['seconds']))
+    for sec in profile['patterns']:
+        print_section(sec, out)
+
+if __name__ == '__main__':
+    main()
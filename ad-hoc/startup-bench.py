@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Time to first output of the command line tools: run each command
+# several times and report the best time until the first byte appears
+# on stdout or stderr, and until the command exits.
+#
+# usage: startup-bench.py [-r REPEAT] [-i file.txt] [command ...]
+#
+# Commands are run from the current directory (runtime resources are
+# looked up in ./run). Without commands, times the default set below,
+# the one-sentence parse uses file.txt if given.
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+DABADIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT = [
+    'mparser.py --help',
+    'mparser.py --noparse',
+    'mparser.py -i {infile} -o -',
+    'dabased.py --help',
+    'metaprint.py --help',
+    'disambiguation.py --help',
+    ]
+
+
+def run(command):
+    'command -> (seconds to first output or None, seconds to exit, exit code)'
+    start = time.time()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    first = None
+    if proc.stdout.read(1):
+        first = time.time() - start
+    proc.stdout.read()
+    code = proc.wait()
+    return first, time.time() - start, code
+
+def main():
+    aparser = argparse.ArgumentParser(description='Time to first output of daba command line tools')
+    aparser.add_argument('-r', '--repeat', type=int, default=5, help='Runs per command, best time is reported')
+    aparser.add_argument('-i', '--infile', default=None, help='Text file for the parse command')
+    aparser.add_argument('commands', nargs='*', help='Commands relative to daba directory, e.g. "mparser.py -h"')
+    args = aparser.parse_args()
+    commands = args.commands or [c for c in DEFAULT if args.infile or '{infile}' not in c]
+    print '{0:>8} {1:>8} {2:>5}  {3}'.format('first', 'total', 'exit', 'command')
+    for c in commands:
+        words = c.format(infile=args.infile).split()
+        command = [sys.executable, os.path.join(DABADIR, words[0])] + words[1:]
+        results = [run(command) for i in range(args.repeat)]
+        firsts = [r[0] for r in results if r[0] is not None]
+        first = '{0:.3f}'.format(min(firsts)) if firsts else '-'
+        print '{0:>8} {1:>8.3f} {2:>5}  {3}'.format(first, min(r[1] for r in results), results[-1][2], c)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Compare precompiled mparser.Tokenizer with the funcparserlib lexer
+# built from the same specs: check that tokens are identical and time both.
+#
+# usage: tokenizer-bench.py file.txt [repeat]
+
+import sys
+import time
+import funcparserlib.lexer
+from mparser import Tokenizer, TOKEN_SPECS
+
+
+def timeit(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def main():
+    with open(sys.argv[1]) as f:
+        txt = f.read().decode('utf-8')
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    paras = txt.split(u'\n\n')
+
+    def legacy():
+        return [[(t.type, t.value, t.start, t.end) for t in funcparserlib.lexer.make_tokenizer(TOKEN_SPECS)(p)] for p in paras]
+
+    tkz = Tokenizer()
+    def compiled():
+        return [[(t.type, t.value, t.start, t.end) for t in tkz.tokenize(p)] for p in paras]
+
+    def bulk():
+        return sum(1 for t in tkz.tokenize(txt))
+
+    oldtime, oldtoks = timeit(legacy, repeat)
+    newtime, newtoks = timeit(compiled, repeat)
+    bulktime, numtoks = timeit(bulk, repeat)
+    if oldtoks != newtoks:
+        print 'MISMATCH: tokenizers produce different tokens'
+    print 'tokens:', sum(len(p) for p in newtoks), 'paragraphs:', len(paras)
+    print 'funcparserlib lexer: {0:.3f}s'.format(oldtime)
+    print 'compiled tokenizer:  {0:.3f}s ({1:.1f}x)'.format(newtime, oldtime / newtime)
+    print 'bulk (whole text):   {0:.3f}s, {1} tokens'.format(bulktime, numtoks)
+
+if __name__ == '__main__':
+    main()
@@ -12,11 +12,8 @@
 
 import sys, re, codecs, glob, time, os, collections, argparse, itertools
 import formats,  grammar
-from gdisamb import FileParser
+from formats import FileParser
 from ntgloss import Gloss
-from nltk.tag.crf import CRFTagger
-import nltk.tag.util
-import pycrfsuite
 from differential_tone_coding import apply_filter_to_base_element, get_features_customised, get_duration, sampling, csv_export, unzip, encoder_tones, mode_indicators, marginal_tone, accuray2, get_sub_tone_code_of_sentence, accumulate_tone_code_of_dataset, reshape_tokens_as_sentnece, make_tokens_from_sentence, make_features_from_tokens
 import unicodedata
 import zipfile, ntpath
@@ -50,6 +47,9 @@ def main():
 	aparser.add_argument('-s', '--store', help='Store evaluation resault in file (.csv) for further research purpose', default=None)
 
 	args = aparser.parse_args()
+	# nltk and pycrfsuite are slow to import, load them once arguments are checked
+	from nltk.tag.crf import CRFTagger
+	import pycrfsuite
 	if args.verbose :
 		print 'Arguments received by script'
 		dico = vars(args)
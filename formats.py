@@ -8,12 +8,16 @@ import re
 import codecs
 import unicodedata
 import hashlib
+import json
+import marshal
+import mmap
+import struct
+import zlib
 import xml.etree.cElementTree as e
 import grammar
-from ntgloss import Gloss
+from ntgloss import Gloss, GlossPool, glosspool
 from orthography import detone
-from pytrie import StringTrie as trie
-from collections import namedtuple, MutableMapping, defaultdict, OrderedDict
+from collections import namedtuple, Mapping, MutableMapping, defaultdict, OrderedDict
 
 # Data structure for internal bare text representation:
 # ({metadata}, [para+])
@@ -102,6 +106,84 @@ class TxtReader(BaseReader):
             self.para = re.split(os.linesep + '{2,}', normalizeText(f.read().decode(encoding).strip()))
 
 
+class TxtStreamReader(BaseReader):
+    """Lazy counterpart of TxtReader for large files and pipes.
+
+    Paragraphs are read one at a time as the reader is iterated, the
+    resulting sequence is the same as TxtReader.para. Accepts either a
+    filename or an open binary file object (e.g. sys.stdin).
+    """
+    def __init__(self, filename, encoding="utf-8"):
+        self.isdummy = True
+        self.metadata = {}
+        self.filename = filename
+        self.encoding = encoding
+        self.para = self
+
+    def iter_raw(self):
+        'Split input into paragraphs as soon as separator is complete'
+        sep = re.compile(os.linesep + '{2,}')
+        if isinstance(self.filename, basestring):
+            f = open(self.filename, 'rb')
+        else:
+            f = self.filename
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        buf = u''
+        try:
+            for line in iter(f.readline, ''):
+                # separator may start in the newlines at the end of buffer
+                start = len(buf)
+                while start and buf[start-1] == os.linesep[-1]:
+                    start -= 1
+                buf += decoder.decode(line)
+                m = sep.search(buf, max(0, start-len(os.linesep)))
+                while m and m.end() < len(buf):
+                    yield buf[:m.start()]
+                    buf = buf[m.end():]
+                    m = sep.search(buf)
+            buf += decoder.decode('', final=True)
+        finally:
+            if f is not self.filename:
+                f.close()
+        yield buf
+
+    def __iter__(self):
+        # leading and trailing whitespace is stripped from the whole
+        # text, so paragraphs are held until followed by some text
+        started = False
+        pending = []
+        for para in self.iter_raw():
+            if not started:
+                para = para.lstrip()
+                if not para:
+                    continue
+                started = True
+            if para.strip():
+                for p in pending:
+                    yield normalizeText(p)
+                pending = [para]
+            else:
+                pending.append(para)
+        if pending:
+            yield normalizeText(pending[0].rstrip())
+        elif not started:
+            yield normalizeText(u'')
+
+
+def read_html_metadata(filename):
+    """Read <meta> name/content pairs from the <head> of an html file,
+    without parsing the body"""
+    metadata = OrderedDict()
+    for event, elem in e.iterparse(filename, events=('start', 'end')):
+        if event == 'end' and elem.tag == 'meta':
+            name = elem.get('name')
+            if name is not None:
+                metadata[name] = elem.get('content')
+        elif (event == 'end' and elem.tag == 'head') or (event == 'start' and elem.tag == 'body'):
+            break
+    return metadata
+
+
 class HtmlReader(BaseReader):
     def __init__(self, filename, onlymeta=False, compatibility_mode=True):
         self.filename = filename
@@ -227,7 +309,7 @@ class HtmlReader(BaseReader):
                 gloss = normalizeText(sub.text)
             elif subclass == 'm':
                 morphemes.append(self.elem_to_gloss(sub))
-        return Gloss(form, ps, gloss, tuple(morphemes))
+        return glosspool.intern((form, ps, gloss, tuple(morphemes)))
 
     def parse_sent(self, sent, onlymeta=False):
         text = normalizeText(sent.text)
@@ -295,13 +377,7 @@ class SimpleHtmlWriter(object):
 
 
 class HtmlWriter(object):
-    def __init__(self, (metadata, para), filename, encoding="utf-8"):
-        self.encoding = encoding
-        self.metadata = metadata
-        self.para = para
-        self.filename = filename
-
-        self.stylesheet = """
+    stylesheet = """
       body { font-size: 120%; }
       span.w, span.c { color: #444; font-size: 14px; display: inline-block; float: none; vertical-align: top; padding: 3px 10px 10px 0; }
       span.m { color: red; font-size: 14px; display: block; float: left; vertical-align: top; padding: 3px 10px 10px 0; }
@@ -315,58 +391,135 @@ class HtmlWriter(object):
 
         """
 
+    def __init__(self, (metadata, para), filename, encoding="utf-8"):
+        self.encoding = encoding
+        self.metadata = metadata
+        self.para = para
+        self.filename = filename
+
         root = e.Element('html')
-        head = e.SubElement(root, 'head')
+        root.append(self.make_head(metadata))
+        body = e.SubElement(root, 'body')
+        for para in self.para:
+            body.append(self.para_to_html(para))
+        self.xml = root
+
+    def make_head(self, metadata):
+        head = e.Element('head')
         meta = e.SubElement(head, 'meta', {'http-equiv': 'Content-Type', 'content': 'text/html; charset={0}'.format(self.encoding)})
         for (name, content) in metadata.items():
             md = e.SubElement(head, 'meta', {'name': name, 'content': content})
-        body = e.SubElement(root, 'body')
         style = e.SubElement(head, 'style', {'type': 'text/css'})
         style.text = self.stylesheet
-
-        for para in self.para:
-            par = e.Element('p')
-            for (senttext, sentannot) in para:
-                st = e.SubElement(par, 'span', {'class': 'sent'})
-                st.text = senttext
-                st.tail = '\n'
-                annot = e.SubElement(st, 'span', {'class':'annot'})
-                annot.tail = '\n'
-                for gt in sentannot:
-                    if gt.type in ['Comment']:
-                        c = e.SubElement(annot, 'span', {'class': 'comment'})
-                        c.text = gt.value
-                        c.tail = '\n'
-                    elif gt.type in ['Tag']:
-                        t = e.SubElement(annot, 'span', {'class': 't'})
-                        t.text = gt.value
-                        t.tail = '\n'
-                    elif gt.type in ['c']:
-                        c = e.SubElement(annot, 'span', {'class':'c'})
-                        c.text = gt.value
-                        c.tail = '\n'
-                    elif gt.type in ['w']:
-                        sourceform, stage, glosslist = gt.value
-                        w = e.SubElement(annot, 'span', {'class':'w', 'stage':unicode(stage)})
-                        w.text = sourceform
-                        variant = False
-                        for gloss in glosslist:
-                            if not variant:
-                                l = gloss_to_html(gloss)
-                                l.tail = '\n'
-                                variant=True
-                            else:
-                                #NB: SIDE EFFECT!
-                                l.append(gloss_to_html(gloss, variant=True))
-                                l.tail = '\n'
-                        w.append(l)
-            body.append(par)
-        self.xml = root
+        return head
+
+    def para_to_html(self, para):
+        par = e.Element('p')
+        for (senttext, sentannot) in para:
+            st = e.SubElement(par, 'span', {'class': 'sent'})
+            st.text = senttext
+            st.tail = '\n'
+            annot = e.SubElement(st, 'span', {'class':'annot'})
+            annot.tail = '\n'
+            for gt in sentannot:
+                if gt.type in ['Comment']:
+                    c = e.SubElement(annot, 'span', {'class': 'comment'})
+                    c.text = gt.value
+                    c.tail = '\n'
+                elif gt.type in ['Tag']:
+                    t = e.SubElement(annot, 'span', {'class': 't'})
+                    t.text = gt.value
+                    t.tail = '\n'
+                elif gt.type in ['c']:
+                    c = e.SubElement(annot, 'span', {'class':'c'})
+                    c.text = gt.value
+                    c.tail = '\n'
+                elif gt.type in ['w']:
+                    sourceform, stage, glosslist = gt.value
+                    w = e.SubElement(annot, 'span', {'class':'w', 'stage':unicode(stage)})
+                    w.text = sourceform
+                    variant = False
+                    for gloss in glosslist:
+                        if not variant:
+                            l = gloss_to_html(gloss)
+                            l.tail = '\n'
+                            variant=True
+                        else:
+                            #NB: SIDE EFFECT!
+                            l.append(gloss_to_html(gloss, variant=True))
+                            l.tail = '\n'
+                    w.append(l)
+        return par
 
     def write(self):
         e.ElementTree(self.xml).write(self.filename, self.encoding)
 
 
+class HtmlStreamWriter(HtmlWriter):
+    """Writes parsed paragraphs one at a time, output is identical to
+    HtmlWriter's. Accepts a filename or an open file object. A named
+    file is written under a temporary name and renamed on close, so
+    that an interrupted run never leaves a truncated output.
+
+    Use as a context manager:
+        with HtmlStreamWriter(metadata, filename) as writer:
+            writer.write_para(para)
+    """
+    def __init__(self, metadata, filename, encoding="utf-8"):
+        self.encoding = encoding
+        self.metadata = metadata
+        self.filename = filename
+        self.numpar = 0
+        if isinstance(filename, basestring):
+            self.tmpname = filename + '.part'
+            self.outfile = open(self.tmpname, 'wb')
+        else:
+            self.tmpname = None
+            self.outfile = filename
+        if self.encoding.lower() not in ('utf-8', 'us-ascii'):
+            self.outfile.write("<?xml version='1.0' encoding='{0}'?>\n".format(self.encoding))
+        self.outfile.write('<html>')
+        self.serialize(self.make_head(metadata))
+        self.outfile.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def serialize(self, elem):
+        e.ElementTree(elem).write(self.outfile, self.encoding, xml_declaration=False)
+
+    def write_para(self, para):
+        if not self.numpar:
+            self.outfile.write('<body>')
+        self.serialize(self.para_to_html(para))
+        self.outfile.flush()
+        self.numpar += 1
+
+    def close(self):
+        if self.numpar:
+            self.outfile.write('</body></html>')
+        else:
+            self.outfile.write('<body /></html>')
+        self.outfile.flush()
+        if self.tmpname:
+            self.outfile.close()
+            if os.path.exists(self.filename):
+                # os.rename does not replace existing files on Windows
+                os.unlink(self.filename)
+            os.rename(self.tmpname, self.filename)
+
+    def abort(self):
+        if self.tmpname:
+            self.outfile.close()
+            os.unlink(self.tmpname)
+
+
 class FileWrapper(object):
     def __init__(self, encoding='utf-8'):
         self.encoding = encoding
@@ -403,6 +556,42 @@ class FileWrapper(object):
             SimpleHtmlWriter((metadata, result), filename, self.encoding).write()
 
 
+class FileParser(object):
+    'Disambiguation file: sentences with lists of selected glosses'
+    def __init__(self):
+        self.glosses = []
+        self.dirty = False
+
+    def read_file(self, filename):
+        freader = HtmlReader(filename)
+        self.metadata = freader.metadata
+        self.glosses = []
+        for pnum, par in enumerate(freader.glosses):
+            for snum, sent in enumerate(par):
+                # tuple(sent_text, selectlist, glosslist, index)
+                self.glosses.append((sent[0], [[] for i in sent[1]], sent[1], (pnum, snum)))
+                self.numsent = freader.numsent
+                self.numwords = freader.numwords
+
+    def write(self, filename):
+        out = [[]]
+        for sent in self.glosses:
+            pnum = sent[3][0]
+            if pnum > len(out)-1:
+                out.append([])
+            outgloss = []
+            for selectlist, glosstoken in zip(sent[1], sent[2]):
+                if not selectlist:
+                    outgloss.append(glosstoken)
+                else:
+                    if glosstoken.type == 'w':
+                        glosstoken.setGlosslist(selectlist)
+                    outgloss.append(glosstoken)
+            out[-1].append((sent[0], outgloss))
+        fwriter = HtmlWriter((self.metadata, out), filename)
+        fwriter.write()
+
+
 class DictWriter(object):
     def __init__(self, udict, filename, lang='', name='', ver='', add=False, encoding='utf-8'):
         self.lang = lang
@@ -443,6 +632,7 @@ class DictWriter(object):
 
 class DabaDict(MutableMapping):
     def __init__(self):
+        from pytrie import StringTrie as trie
         self._data = trie({})
         self.lang = None
         self.name = None
@@ -496,6 +686,303 @@ class DabaDict(MutableMapping):
     def iter_prefixes(self, string):
         return self._data.iter_prefixes(string)
 
+    def has_prefix(self, prefix):
+        'Check if any key starts with prefix'
+        for key in self._data.iterkeys(prefix):
+            return True
+        return False
+
+
+# Compiled dictionary format (.bdx), read via mmap by MappedDict:
+#   header   magic, then <IIIIII: number of keys, metadata length,
+#            offsets of index, hash table, keys and records areas,
+#            then <I: number of hash table slots (a power of two)
+#   metadata json object with lang, name, ver and hash
+#   index    <III per key, sorted by utf-8 key: key offset, key length,
+#            records offset; records of a key end where next ones start
+#   table    open addressing hash table (crc32, linear probing) of all
+#            keys and of all their prefixes, <III per slot: offset of
+#            a key starting with the prefix, prefix length, and 0 for
+#            empty slot, 1 for a prefix only, index of the key + 2
+#   keys     utf-8 encoded keys
+#   records  glosses of each key as marshalled tuples
+MAPPED_MAGIC = 'DABADIX2'
+MAPPED_HEADER = struct.Struct('<IIIIIII')
+MAPPED_INDEX = struct.Struct('<III')
+MAPPED_SLOT = struct.Struct('<III')
+MAPPED_MEMO_SIZE = 100000
+
+
+def gloss_to_tuple(gloss):
+    if gloss is None:
+        return None
+    return (gloss.form, gloss.ps, gloss.gloss, tuple(gloss_to_tuple(m) for m in gloss.morphemes))
+
+def tuple_to_gloss(t, pool=None):
+    if t is None:
+        return None
+    if pool is not None:
+        return pool.intern(t)
+    form, ps, gloss, morphemes = t
+    return Gloss(form, ps, gloss, tuple(tuple_to_gloss(m) for m in morphemes))
+
+
+class MappedDictWriter(object):
+    def __init__(self, dic, filename):
+        self.dic = dic
+        self.filename = filename
+
+    def write(self):
+        keys = sorted((key.encode('utf-8'), key) for key in self.dic)
+        meta = json.dumps(dict((a, getattr(self.dic, a)) for a in ('lang', 'name', 'ver', 'hash')))
+        index = []
+        keydata = []
+        recdata = []
+        # prefix bytes -> (key offset, slot value)
+        entries = {}
+        keyoffset = recoffset = 0
+        for i, (keybytes, key) in enumerate(keys):
+            records = marshal.dumps(tuple(gloss_to_tuple(g) for g in self.dic[key]))
+            index.append(MAPPED_INDEX.pack(keyoffset, len(keybytes), recoffset))
+            for end in range(len(keybytes)):
+                entries.setdefault(keybytes[:end], (keyoffset, 1))
+            entries[keybytes] = (keyoffset, i + 2)
+            keydata.append(keybytes)
+            recdata.append(records)
+            keyoffset += len(keybytes)
+            recoffset += len(records)
+        numslots = 1
+        while numslots < 2 * len(entries):
+            numslots *= 2
+        table = [None] * numslots
+        for prefix in sorted(entries):
+            slot = zlib.crc32(prefix) & (numslots - 1)
+            while table[slot] is not None:
+                slot = (slot + 1) & (numslots - 1)
+            offset, value = entries[prefix]
+            table[slot] = MAPPED_SLOT.pack(offset, len(prefix), value)
+        empty = MAPPED_SLOT.pack(0, 0, 0)
+        indexoffset = len(MAPPED_MAGIC) + MAPPED_HEADER.size + len(meta)
+        tableoffset = indexoffset + MAPPED_INDEX.size * len(keys)
+        keysoffset = tableoffset + MAPPED_SLOT.size * numslots
+        recsoffset = keysoffset + keyoffset
+        tmpname = self.filename + '.part'
+        with open(tmpname, 'wb') as o:
+            o.write(MAPPED_MAGIC)
+            o.write(MAPPED_HEADER.pack(len(keys), len(meta), indexoffset, tableoffset, keysoffset, recsoffset, numslots))
+            o.write(meta)
+            o.write(''.join(index))
+            o.write(''.join(slot or empty for slot in table))
+            o.write(''.join(keydata))
+            o.write(''.join(recdata))
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+        os.rename(tmpname, self.filename)
+
+
+class MappedDict(Mapping):
+    """Read-only dictionary over a memory-mapped .bdx file.
+
+    Provides the same lookup interface as DabaDict. Keys and their
+    prefixes are found through a hash table in the mapped file, glosses
+    are unpacked only when looked up. Loading is instant and processes
+    using the same file share its pages.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAPPED_MAGIC)] != MAPPED_MAGIC:
+            raise ValueError('Not a compiled dictionary: {0}'.format(filename))
+        self._len, metalen, self._index, self._table, self._keys, self._recs, numslots = MAPPED_HEADER.unpack_from(self._mm, len(MAPPED_MAGIC))
+        self._mask = numslots - 1
+        # recent probe results, queries repeat a lot within a text
+        self._memo = {}
+        metastart = len(MAPPED_MAGIC) + MAPPED_HEADER.size
+        meta = json.loads(self._mm[metastart:metastart+metalen])
+        self.lang = meta['lang']
+        self.name = meta['name']
+        self.ver = meta['ver']
+        self.hash = meta['hash']
+
+    @property
+    def description(self):
+        return ' '.join([self.lang, self.name, self.ver])
+
+    def __repr__(self):
+        return ' '.join((self.lang, self.name, self.ver, self.hash))
+
+    def __eq__(self, other):
+        return all([getattr(self, a) == getattr(other, a) for a in ('lang', 'name', 'ver', 'hash')])
+
+    def __ne__(self, other):
+        return not self == other
+
+    def attributed(self):
+        return all([self.lang, self.name, self.ver])
+
+    def close(self):
+        self._mm.close()
+
+    def __len__(self):
+        return self._len
+
+    def _probe(self, prefixbytes):
+        'bytes -> slot value: 0 if not found, 1 for prefix, index+2 for key'
+        try:
+            return self._memo[prefixbytes]
+        except KeyError:
+            pass
+        if len(self._memo) >= MAPPED_MEMO_SIZE:
+            self._memo.clear()
+        mm = self._mm
+        slot = zlib.crc32(prefixbytes) & self._mask
+        while True:
+            offset, length, value = MAPPED_SLOT.unpack_from(mm, self._table + MAPPED_SLOT.size * slot)
+            if not value:
+                break
+            if length == len(prefixbytes):
+                start = self._keys + offset
+                if mm[start:start+length] == prefixbytes:
+                    break
+            slot = (slot + 1) & self._mask
+        self._memo[prefixbytes] = value
+        return value
+
+    def _records(self, i):
+        keyoffset, keylen, start = MAPPED_INDEX.unpack_from(self._mm, self._index + MAPPED_INDEX.size * i)
+        if i + 1 < self._len:
+            end = MAPPED_INDEX.unpack_from(self._mm, self._index + MAPPED_INDEX.size * (i + 1))[2]
+        else:
+            end = len(self._mm) - self._recs
+        return marshal.loads(self._mm[self._recs+start:self._recs+end])
+
+    def __getitem__(self, key):
+        value = self._probe(key.encode('utf-8'))
+        if value < 2:
+            raise KeyError(key)
+        return [tuple_to_gloss(t, glosspool) for t in self._records(value - 2)]
+
+    def __contains__(self, key):
+        return self._probe(key.encode('utf-8')) > 1
+
+    def has_prefix(self, prefix):
+        return self._probe(prefix.encode('utf-8')) > 0
+
+    def __iter__(self):
+        for i in xrange(self._len):
+            keyoffset, keylen, recoffset = MAPPED_INDEX.unpack_from(self._mm, self._index + MAPPED_INDEX.size * i)
+            start = self._keys + keyoffset
+            yield self._mm[start:start+keylen].decode('utf-8')
+
+    def iter_prefixes(self, string):
+        'Keys that are prefixes of string, shortest first (like pytrie)'
+        encoded = string.encode('utf-8')
+        numchars = 0
+        for end in range(len(encoded) + 1):
+            # skip positions inside multibyte characters
+            if end < len(encoded) and ord(encoded[end]) & 0xC0 == 0x80:
+                continue
+            value = self._probe(encoded[:end])
+            if not value:
+                break
+            if value > 1:
+                yield string[:numchars]
+            numchars += 1
+
+
+class PatchedDict(Mapping):
+    """Read-only dictionary made of a base dictionary (DabaDict or
+    MappedDict) and a journal of changed entries.
+
+    journal is a dict with lang, name, ver and hash of the resulting
+    dictionary, hash of the base dictionary and changes: {key: [Gloss]}
+    for inserted and changed entries, {key: None} for deleted ones.
+    """
+    def __init__(self, base, journal):
+        if journal['base'] != base.hash:
+            raise ValueError('Journal does not apply to dictionary {0}'.format(base))
+        self.base = base
+        self.journal = journal
+        self.changes = journal['changes']
+        self.lang = journal['lang']
+        self.name = journal['name']
+        self.ver = journal['ver']
+        self.hash = journal['hash']
+        self._prefixes = None
+        self._len = len(base)
+        for key, value in self.changes.iteritems():
+            if key in base:
+                if value is None:
+                    self._len -= 1
+            elif value is not None:
+                self._len += 1
+
+    @property
+    def description(self):
+        return ' '.join([self.lang, self.name, self.ver])
+
+    def __repr__(self):
+        return ' '.join((self.lang, self.name, self.ver, self.hash))
+
+    def __eq__(self, other):
+        return all([getattr(self, a) == getattr(other, a) for a in ('lang', 'name', 'ver', 'hash')])
+
+    def __ne__(self, other):
+        return not self == other
+
+    def attributed(self):
+        return all([self.lang, self.name, self.ver])
+
+    def close(self):
+        if isinstance(self.base, MappedDict):
+            self.base.close()
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            value = self.changes[key]
+            if value is None:
+                raise KeyError(key)
+            return list(value)
+        return self.base[key]
+
+    def __contains__(self, key):
+        if key in self.changes:
+            return self.changes[key] is not None
+        return key in self.base
+
+    def __iter__(self):
+        changes = self.changes
+        for key in self.base:
+            if key not in changes:
+                yield key
+        for key, value in changes.iteritems():
+            if value is not None:
+                yield key
+
+    def iter_prefixes(self, string):
+        changes = self.changes
+        prefixes = [p for p in self.base.iter_prefixes(string) if p not in changes]
+        prefixes.extend(string[:i] for i in range(len(string) + 1) if changes.get(string[:i]) is not None)
+        return sorted(prefixes, key=len)
+
+    def has_prefix(self, prefix):
+        # may be true for prefixes of deleted keys only
+        if self._prefixes is None:
+            self._prefixes = set(key[:i] for key, value in self.changes.iteritems() if value is not None for i in range(len(key) + 1))
+        return prefix in self._prefixes or self.base.has_prefix(prefix)
+
+
+def hash_records(records):
+    'Hash of a DabaDict filled with [(key, Gloss)] in this order'
+    sha = hashlib.sha1()
+    for key, value in records:
+        sha.update(repr((key, value)))
+    return sha.hexdigest()
+
 
 class VariantsDict(MutableMapping):
     def __init__(self):
@@ -550,9 +1037,11 @@ class VariantsDict(MutableMapping):
 
 class DictReader(object):
     def __init__(self, filename, encoding='utf-8', store=True,
-                 variants=False, polisemy=False):
+                 variants=False, polisemy=False, records=False):
 
         self._dict = DabaDict()
+        # (key, Gloss) pairs in the order they are stored
+        self.records = []
         self._variants = VariantsDict()
         self._polisemy = defaultdict(ddlist)
         self.line = 0
@@ -560,6 +1049,9 @@ class DictReader(object):
         key = None
         ps = ()
         ge = ''
+        # not the shared glosspool, which would keep the dictionary
+        # alive after it is compiled
+        pool = GlossPool()
 
         def parsemm(v):
             try:
@@ -568,7 +1060,7 @@ class DictReader(object):
                     ps = tuple(p.split('/'))
                 else:
                     ps = ()
-                return Gloss(f, ps, g, ())
+                return pool.intern((f, ps, g, ()))
             except (ValueError):
                 print "Error line:", str(self.line), unicode(v).encode('utf-8')
 
@@ -580,15 +1072,20 @@ class DictReader(object):
 
         def push_items(primarykey, lemmalist):
             for key, lx in lemmalist:
-                self._dict[key] = lx
+                keys = [key]
                 detonedkey = detone(key)
                 if not detonedkey == key:
-                    self._dict[detonedkey] = lx
+                    keys.append(detonedkey)
+                for k in keys:
+                    if store:
+                        self._dict[k] = lx
+                    if records:
+                        self.records.append((k, lx))
 
         def process_record(lemmalist):
-            lemmalist = [(key, item._replace(ps=ps,gloss=ge)) for key, item in lemmalist]
+            lemmalist = [(key, pool.intern(item._replace(ps=ps,gloss=ge))) for key, item in lemmalist]
             if lemmalist and not ps == ('mrph',):
-                if store:
+                if store or records:
                     push_items(key, lemmalist)
                 if variants and len(lemmalist) > 1:
                     self._variants.add(zip(*lemmalist)[1])
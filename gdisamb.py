@@ -30,6 +30,7 @@ import wx.stc
 
 import formats
 import grammar
+from formats import FileParser
 from funcparserlib.lexer import LexerError
 from funcparserlib.parser import NoParseError
 from intervaltree import IntervalTree
@@ -93,41 +94,6 @@ def makeGlossString(gloss, morphemes=False):
         return u'{0} ({1}){3}{2}'.format(gloss.form, '/'.join(gloss.ps), gloss.gloss, os.linesep)
 
 
-class FileParser(object):
-    def __init__(self):
-        self.glosses = []
-        self.dirty = False
-
-    def read_file(self, filename):
-        freader = formats.HtmlReader(filename)
-        self.metadata = freader.metadata
-        self.glosses = []
-        for pnum, par in enumerate(freader.glosses):
-            for snum, sent in enumerate(par):
-                # tuple(sent_text, selectlist, glosslist, index)
-                self.glosses.append((sent[0], [[] for i in sent[1]], sent[1], (pnum, snum)))
-                self.numsent = freader.numsent
-                self.numwords = freader.numwords
-
-    def write(self, filename):
-        out = [[]]
-        for sent in self.glosses:
-            pnum = sent[3][0]
-            if pnum > len(out)-1:
-                out.append([])
-            outgloss = []
-            for selectlist, glosstoken in zip(sent[1], sent[2]):
-                if not selectlist:
-                    outgloss.append(glosstoken)
-                else:
-                    if glosstoken.type == 'w':
-                        glosstoken.setGlosslist(selectlist)
-                    outgloss.append(glosstoken)
-            out[-1].append((sent[0], outgloss))
-        fwriter = formats.HtmlWriter((self.metadata, out), filename)
-        fwriter.write()
-
-
 class EditLogger(object):
     def __init__(self, filename, encoding='utf-8'):
         self.fileobj = codecs.open(filename, 'a+', encoding=encoding)
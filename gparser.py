@@ -21,7 +21,7 @@ import os
 import mparser
 import formats
 from contextlib import contextmanager
-from plugins import OrthographyConverter
+from plugins import plugin_titles
 
 def get_outdir(fname):
     dirname = os.path.dirname(fname)
@@ -146,8 +146,7 @@ class ConverterLister(wx.Panel):
         wx.Panel.__init__(self, parent, *args, **kwargs)
         #FIXME: make default plugins configurable from config file
         self.selection = ('apostrophe',)
-        mparser.load_plugins()
-        self.converters = OrthographyConverter.get_plugins().keys()
+        self.converters = plugin_titles().keys()
         converterbox = wx.StaticBox(self, -1, "Available Orthographic Converters")
         self.csizer = wx.StaticBoxSizer(converterbox, wx.VERTICAL)
         self.converterlist = wx.CheckListBox(self, wx.ID_ANY, choices=self.converters)
@@ -2,9 +2,11 @@
 # -*- encoding: utf-8 -*-
 
 import re
+import hashlib
 from ntgloss import Pattern, Gloss
-from funcparserlib.parser import *
-from funcparserlib.lexer import make_tokenizer, Token, LexerError
+
+# funcparserlib is imported when a grammar or a gloss string is first
+# parsed, tools that never do so start without it.
 
 PSLIST = [
         'mrph',
@@ -50,6 +52,7 @@ def tokenize(string):
             #('Name', (ur'(\w[\u0300\u0301]?([-./](\w[\u0300\u0301]?)+)*|[-0-9][-0-9]*)',re.UNICODE))
             ]
     useless = ['Comment', 'NL', 'JunkSpace']
+    from funcparserlib.lexer import make_tokenizer
     tok = make_tokenizer(specs)
     #print "DEBUG TOKENIZER: ", [x for x in tok(string)]
     return [x for x in tok(string) if x.type not in useless]
@@ -73,11 +76,6 @@ def unwrap_re(tupl):
 
 tokval = lambda x: x.value
 unquote = lambda s: s.strip('"')
-name = some(lambda t: t.type in ['Name', 'QuotedName']) >> tokval >> unquote
-pslabel = some(lambda t: t.value in PSLIST) >> tokval
-space = some(lambda t: t.type == 'Space') >> tokval
-op = lambda s: a(Token('Op', s)) >> tokval
-op_ = lambda s: skip(op(s))
 foldl = lambda s: [s]
 unfoldl = lambda l: [k for j in [i for i in l if i] for k in j]
 unarg = lambda f: lambda args: f(*args)
@@ -88,6 +86,17 @@ denonetuple = lambda t: t or ()
 filternone = lambda s: [i for i in s if i]
 despace = lambda s: [i for i in s if s is not ' ']
 
+def terminals():
+    'Token parsers shared by the gloss and grammar parsers: name, pslabel, space, op, op_'
+    from funcparserlib.parser import some, a, skip
+    from funcparserlib.lexer import Token
+    name = some(lambda t: t.type in ['Name', 'QuotedName']) >> tokval >> unquote
+    pslabel = some(lambda t: t.value in PSLIST) >> tokval
+    space = some(lambda t: t.type == 'Space') >> tokval
+    op = lambda s: a(Token('Op', s)) >> tokval
+    op_ = lambda s: skip(op(s))
+    return name, pslabel, space, op, op_
+
 def flatten_list(l):
     for el in l:
         if isinstance(el, list) and not isinstance(el, basestring):
@@ -105,10 +114,13 @@ def str_tokenize(string):
             ('Name', (ur'[^:/ \[\]\r\t\n]+', re.UNICODE)),
             ]
     useless = ['JunkSpace']
+    from funcparserlib.lexer import make_tokenizer
     tok = make_tokenizer(specs)
     return [x for x in tok(string) if x.type not in useless]
 
 def stringgloss_parser():
+    from funcparserlib.parser import maybe, many, skip, forward_decl, finished
+    name, pslabel, space, op, op_ = terminals()
     ps = pslabel + maybe(many(op_('/') + pslabel)) >> flatten_list >> tuple
     lemma = name + op_(':') + ( maybe(ps) >> denonetuple ) + op_(':') + maybe(name) 
     fullgloss = forward_decl()
@@ -120,6 +132,8 @@ def stringgloss_parser():
 
 
 def fullgloss_parser():
+    from funcparserlib.parser import some, maybe, oneplus, many, skip, forward_decl
+    name, pslabel, space, op, op_ = terminals()
     regex = some(lambda t: t.type == 'Regex') >> tokval
     re_or_string = regex | name
     unregex = regex >> unwrap_re
@@ -136,6 +150,9 @@ def fullgloss_parser():
 
 def parse(seq):
     'Sequence(Token) -> grammar dict'
+    from funcparserlib.parser import a, maybe, oneplus, many, skip, finished
+    from funcparserlib.lexer import Token
+    name, pslabel, space, op, op_ = terminals()
     make_patterns = lambda x: ('patterns', x)
     n = lambda s: a(Token('Name', s)) >> tokval
     # plan syntax
@@ -179,7 +196,9 @@ def preprocess(gstring):
 class Grammar(object):
     def __init__(self,filename,encoding='utf-8'):
         with open(filename, 'r') as gf:
-            text = preprocess(gf.read().decode(encoding))
+            source = gf.read()
+            self.hash = hashlib.sha1(source).hexdigest()
+            text = preprocess(source.decode(encoding))
             gdict = parse(tokenize(text))
             self.plan = gdict['plan']
             self.patterns = gdict['patterns']
@@ -16,40 +16,100 @@
 import newmorph
 import grammar
 from ntgloss import Gloss
+from orthography import detone
 import os
 import re
 import argparse
 import sys
 import cPickle
-import funcparserlib.lexer
+import hashlib
+import json
+import time
+import traceback
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+import threading
+import Queue
+import weakref
 import formats
-from plugins import OrthographyConverter
+from collections import OrderedDict, Mapping
+from plugins import load_plugin, plugin_titles
+
+
+# Token specifications in funcparserlib format, tried in order: the first
+# matching regex wins. Only the first spec needs to match across lines,
+# it uses [\s\S] instead of DOTALL so that all specs can be joined
+# into a single regex (none of the non-unicode specs depends on
+# UNICODE flag either).
+TOKEN_SPECS = [
+        ('Comment', (r'<c>[\s\S]*?</c>',)),
+        ('Comment', (r'<sp>.*?</sp>',)),
+        ('SentPunct', (r'<st>',)),
+        ('Tag', (r'<.*?>',)),
+        ('Par', (r'(\r?\n){2,}',)),
+        ('NL', (r'[\r\n]',)),
+        ('Space', (r'\s+',re.UNICODE)),
+        ('Word', (ur'[nN]\u00b0', re.UNICODE)),
+        ('Word', (r'\d+nan', re.UNICODE)),
+        ('Cardinal', (r'(\d([-.,:]\d)?)+',re.UNICODE)),
+        #FIXME: hardcoded acute and grave accents plus round apostrophe (shoud not split words)
+        ('Word', (ur'(\w\.){2,}', re.UNICODE)),
+        ('Word', (ur"[\w\u0300\u0301\u0302\u030c\u0308\u07eb\u07ec\u07ed\u07ee\u07ef\u07f0\u07f1\u07f2\u07f3\u07f6\u07fa-]+['\u2019\u07f4\u07f5]",re.UNICODE)),
+        ('Word', (ur"(\w[\u0300\u0301\u0302\u030c\u0308\u07eb\u07ec\u07ed\u07ee\u07ef\u07f0\u07f1\u07f2\u07f3\u07f6\u07fa-]{0,2})+",re.UNICODE)),
+        ('SentPunct', (ur'([.!?\u061f\u07f9]+(?=[\s\n\u200f])|:(?=\s*\n))',re.UNICODE)),
+        ('Punct', (ur'([:;,\u061b\u060c\u07f8\u200f(){}"]+)',re.UNICODE)),
+        ('Nonword', (r'\W', re.UNICODE)),
+        ]
 
 
 class Tokenizer(object):
+    # all specs compiled once into an alternation of named groups,
+    # alternatives are tried in order just like in funcparserlib lexer
+    regex = re.compile(u'|'.join(u'(?P<t{0}>{1})'.format(i, spec[0]) for i, (name, spec) in enumerate(TOKEN_SPECS)), re.UNICODE)
+    types = dict((u't{0}'.format(i), name) for i, (name, spec) in enumerate(TOKEN_SPECS))
+
     def tokenize(self, string):
-        'unicode -> Sequence(Token)'
-        specs = [
-                ('Comment', (r'<c>.*?</c>',re.DOTALL)),
-                ('Comment', (r'<sp>.*?</sp>',)),
-                ('SentPunct', (r'<st>',)),
-                ('Tag', (r'<.*?>',)),
-                ('Par', (r'(\r?\n){2,}',)),
-                ('NL', (r'[\r\n]',)),
-                ('Space', (r'\s+',re.UNICODE)),
-                ('Word', (ur'[nN]\u00b0', re.UNICODE)),
-                ('Word', (r'\d+nan', re.UNICODE)),
-                ('Cardinal', (r'(\d([-.,:]\d)?)+',re.UNICODE)),
-                #FIXME: hardcoded acute and grave accents plus round apostrophe (shoud not split words)
-                ('Word', (ur'(\w\.){2,}', re.UNICODE)),
-                ('Word', (ur"[\w\u0300\u0301\u0302\u030c\u0308\u07eb\u07ec\u07ed\u07ee\u07ef\u07f0\u07f1\u07f2\u07f3\u07f6\u07fa-]+['\u2019\u07f4\u07f5]",re.UNICODE)),
-                ('Word', (ur"(\w[\u0300\u0301\u0302\u030c\u0308\u07eb\u07ec\u07ed\u07ee\u07ef\u07f0\u07f1\u07f2\u07f3\u07f6\u07fa-]{0,2})+",re.UNICODE)),
-                ('SentPunct', (ur'([.!?\u061f\u07f9]+(?=[\s\n\u200f])|:(?=\s*\n))',re.UNICODE)),
-                ('Punct', (ur'([:;,\u061b\u060c\u07f8\u200f(){}"]+)',re.UNICODE)),
-                ('Nonword', (r'\W', re.UNICODE)),
-                ]
-        tok = funcparserlib.lexer.make_tokenizer(specs)
-        return tok(string)
+        """unicode -> Sequence(Token)
+
+        Yields tokens lazily, so a whole document may be tokenized in one
+        scan. Tokens are identical to those of funcparserlib lexer built
+        from TOKEN_SPECS, including positions.
+        """
+        from funcparserlib.lexer import Token, LexerError
+        match = self.regex.match
+        types = self.types
+        line, pos = 1, 0
+        i = 0
+        length = len(string)
+        while i < length:
+            m = match(string, i)
+            if m is None:
+                raise LexerError((line, pos + 1), string.splitlines()[line - 1])
+            value = m.group()
+            start = (line, pos + 1)
+            nls = value.count(u'\n')
+            if nls:
+                line += nls
+                pos = len(value) - value.rfind(u'\n') - 1
+            else:
+                pos += len(value)
+            yield Token(types[m.lastgroup], value, start, (line, pos))
+            i = m.end()
+
+    def split_paragraphs(self, toklist):
+        'Sequence(Token) -> Sequence([Token]), split at Par tokens'
+        partoks = []
+        for tok in toklist:
+            if tok.type == 'Par':
+                yield partoks
+                partoks = []
+            else:
+                partoks.append(tok)
+        if partoks:
+            yield partoks
 
     def split_sentences(self, toklist):
         senttoks = []
@@ -63,16 +123,81 @@ class Tokenizer(object):
 
 
 class ChainDict(object):
+    """ Joint lookup interface to several dictionaries.
+
+    Dictionaries are looked up in a fixed order: those given priority by
+    set_priority first, then the others in the order they were added
+    (manifest order for DictLoader). With more than one dictionary, a
+    merged index maps each key to the dictionaries containing it, in
+    lookup order, so that lookups and prefix walks are done once for all
+    of them. The index is built on first lookup (dictionaries may be
+    loaded lazily) and then updated by add/remove/replace.
+
+    In firstmatch mode, lookup returns glosses from the first dictionary
+    containing the key only.
+    """
     def __init__(self, *maps):
-        self._maps = dict((dic.hash, dic) for dic in maps)
+        self._maps = OrderedDict((dic.hash, dic) for dic in maps)
+        self._ids = None
+        self._index = None
+        self._stale = True
+        self.firstmatch = False
+        self.priority = []
+
+    def _sort(self):
+        'Compute lookup order'
+        first = [sha for sha in self.priority if sha in self._maps]
+        self._ids = first + [sha for sha in self._maps if sha not in first]
+        self._dictlist = [self._maps[sha] for sha in self._ids]
 
     @property
     def ids(self):
-        return self._maps.viewkeys()
+        'Dictionary ids in lookup order'
+        if self._ids is None:
+            self._sort()
+        return self._ids
 
     @property
     def dictlist(self):
-        return self._maps.viewvalues()
+        'Dictionaries in lookup order'
+        if self._ids is None:
+            self._sort()
+        return self._dictlist
+
+    def _reindex(self):
+        'Build merged index from scratch, single dictionary needs none'
+        self._stale = False
+        if len(self._maps) < 2:
+            self._index = None
+            return
+        index = {}
+        for dic in self.dictlist:
+            for key in dic:
+                index[key] = index.get(key, ()) + (dic,)
+        self._index = index
+
+    def _update_index(self, added=None, removed=None):
+        'Incremental index update, full rebuild if index is missing or ambiguous'
+        if self._stale:
+            return
+        dics = self.dictlist
+        # the same dictionary object may be held under several ids
+        shared = len(set(id(d) for d in dics)) < len(dics) or any(d is removed for d in dics)
+        if self._index is None or len(dics) < 2 or shared:
+            self._reindex()
+            return
+        index = self._index
+        if removed is not None:
+            for key in removed:
+                dics = tuple(d for d in index[key] if d is not removed)
+                if dics:
+                    index[key] = dics
+                else:
+                    del index[key]
+        if added is not None:
+            rank = dict((id(dic), i) for i, dic in enumerate(self.dictlist))
+            for key in added:
+                index[key] = tuple(sorted(index.get(key, ()) + (added,), key=lambda d: rank[id(d)]))
 
     def __len__(self):
         return sum([len(dic) for dic in self.dictlist])
@@ -82,90 +207,401 @@ class ChainDict(object):
             for key in dic:
                 yield key
 
+    def _lookup(self, key):
+        'key -> tuple of dictionaries containing key, in lookup order'
+        if self._stale:
+            self._reindex()
+        if self._index is not None:
+            return self._index.get(key, ())
+        return tuple(dic for dic in self.dictlist if key in dic)
+
     def __contains__(self, key):
-        for dic in self.dictlist:
-            if key in dic:
-                return True
-        return False
+        return bool(self._lookup(key))
 
     def __getitem__(self, key):
+        dics = self._lookup(key)
+        if self.firstmatch:
+            dics = dics[:1]
         result = []
-        for mapping in self.dictlist:
-            try:
-                result.extend(mapping[key])
-            except KeyError:
-                pass
+        for mapping in dics:
+            result.extend(mapping[key])
         if result:
             return result
         else:
             raise KeyError(key)
 
+    def set_priority(self, hashes):
+        'Enable firstmatch lookups, dictionaries ordered by hashes first'
+        self.priority = list(hashes)
+        self.firstmatch = True
+        self._ids = None
+        # index entries are in lookup order
+        self._stale = True
+
     def iter_prefixes(self, key):
-        result = set()
-        for dic in self.dictlist:
-            for prefix in dic.iter_prefixes(key):
-                result.add(prefix)
-        return result
+        'Keys that are prefixes of key in any dictionary, shortest first'
+        if self._stale:
+            self._reindex()
+        if self._index is None:
+            return [prefix for dic in self.dictlist for prefix in dic.iter_prefixes(key)]
+        index = self._index
+        return [key[:end] for end in range(len(key) + 1) if key[:end] in index]
+
+    def has_prefix(self, prefix):
+        'Check if any key starts with prefix'
+        return any(dic.has_prefix(prefix) for dic in self.dictlist)
 
     def iteritems(self):
-        result = []
-        keysseen = []
+        keysseen = set()
         for mapping in self.dictlist:
             for key in mapping:
                 if key not in keysseen:
-                    for lookup in self.dictlist:
-                        try:
-                            result.extend(lookup[key])
-                        except (KeyError):
-                            pass
-                    yield (key, result)
-                    keysseen.append(key)
-                    result = []
+                    yield (key, self[key])
+                    keysseen.add(key)
 
     def get_dict(self, sha):
         return self._maps[sha]
 
     def add(self, dic):
+        if dic.hash in self._maps:
+            self.remove(dic.hash)
         self._maps[dic.hash] = dic
+        self._ids = None
+        self._update_index(added=dic)
 
     def remove(self, sha):
-        del self._maps[sha]
+        dic = self._maps.pop(sha)
+        self._ids = None
+        self._update_index(removed=dic)
 
     def replace(self, sha, dic):
-        self._maps[sha] = dic
+        'Put dic in place of dictionary sha, keeping its position in lookup order'
+        old = self._maps[sha]
+        if old is dic and sha == dic.hash:
+            return
+        if dic.hash != sha and dic.hash in self._maps:
+            self.remove(dic.hash)
+        self._maps = OrderedDict((dic.hash, dic) if k == sha else (k, d) for k, d in self._maps.iteritems())
+        self.priority = [dic.hash if h == sha else h for h in self.priority]
+        self._ids = None
+        self._update_index(added=dic, removed=old)
+
 
+class ResourceLoader(object):
+    """ Base class for loaders that notify subscribers when the resources
+    they hold are changed.
+    """
+    def subscribe(self, callback):
+        # callback should be a bound method, it is held by weak reference
+        # so that subscribing does not keep the subscriber alive
+        self.listeners.append((weakref.ref(callback.im_self), callback.im_func))
+
+    def notify(self):
+        alive = []
+        for ref, func in self.listeners:
+            obj = ref()
+            if obj is not None:
+                func(obj)
+                alive.append((ref, func))
+        self.listeners = alive
+
+
+class LazyDict(Mapping):
+    """ Installed dictionary described by a DictLoader manifest entry.
+
+    The dictionary itself is read from disk the first time it is used.
+    """
+    def __init__(self, loader, entry, dic=None):
+        self.loader = loader
+        self.entry = entry
+        self.lang = entry['lang']
+        self.name = entry['name']
+        self.ver = entry['ver']
+        self.hash = entry['hash']
+        self._dic = dic
+
+    @property
+    def loaded(self):
+        return self._dic is not None
 
-class DictLoader(object):
+    @property
+    def dic(self):
+        if self._dic is None:
+            self._dic = self.loader.materialize(self)
+        return self._dic
+
+    @property
+    def description(self):
+        return ' '.join([self.lang, self.name, self.ver])
+
+    def __repr__(self):
+        return ' '.join((self.lang, self.name, self.ver, self.hash))
+
+    def __eq__(self, other):
+        return all([getattr(self, a) == getattr(other, a) for a in ('lang', 'name', 'ver', 'hash')])
+
+    def __ne__(self, other):
+        return not self == other
+
+    def attributed(self):
+        return all([self.lang, self.name, self.ver])
+
+    def close(self):
+        if isinstance(self._dic, formats.MappedDict):
+            self._dic.close()
+
+    def __len__(self):
+        return self.entry['entries']
+
+    def __iter__(self):
+        return iter(self.dic)
+
+    def __getitem__(self, key):
+        return self.dic[key]
+
+    def __contains__(self, key):
+        return key in self.dic
+
+    def iter_prefixes(self, key):
+        return self.dic.iter_prefixes(key)
+
+    def has_prefix(self, prefix):
+        return self.dic.has_prefix(prefix)
+
+
+class DictLoader(ResourceLoader):
     """ Object holding info about dictionaries state.
+
+    Dictionaries are stored as pickled DabaDict (.bdi) along with
+    compiled copy (.bdx) which is memory-mapped on load when mapped=True.
+    A new version of an installed dictionary is stored as a journal of
+    changed entries (.bdj) over the previous one, see update.
+    Installed dictionaries are listed in a manifest (dictionaries.json)
+    with their lang, name, ver, hash and number of entries. Only those
+    matching langs and names (all by default) are used, each of them is
+    read on first lookup.
     """
-    def __init__(self, runtimedir='./run', verbose=False):
+    manifestname = 'dictionaries.json'
+    # share of changed entries above which update saves dictionary in full
+    maxjournal = 0.1
+
+    def __init__(self, runtimedir='./run', verbose=False, mapped=True, langs=None, names=None):
         self.runtimedir = runtimedir
         self.dictionary = ChainDict()
         self.verbose = verbose
-        for f in os.listdir(self.runtimedir):
+        self.mapped = mapped
+        self.langs = langs
+        self.names = names
+        self.listeners = []
+        self.installed = OrderedDict()
+        for entry, dic in self.scan():
+            self.install(LazyDict(self, entry, dic))
+
+    @property
+    def manifestpath(self):
+        return os.path.join(self.runtimedir, self.manifestname)
+
+    def scan(self):
+        'Read manifest, update entries of new or changed .bdi files -> [(entry, Maybe(dic))]'
+        try:
+            with open(self.manifestpath, 'rb') as f:
+                manifest = dict((entry['file'], entry) for entry in json.load(f))
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            manifest = {}
+        result = []
+        changed = False
+        for f in sorted(os.listdir(self.runtimedir)):
             name, ext = os.path.splitext(f)
             if ext in ['.bdi']:
-                with open(os.path.join(self.runtimedir, f)) as bdi:
-                    dic = cPickle.load(bdi)
-                    assert isinstance(dic, formats.DabaDict)
-                    self.load(dic)
-    
+                path = os.path.join(self.runtimedir, f)
+                entry = manifest.get(f)
+                if entry is not None and entry.get('mtime') == self.mtime(path):
+                    result.append((entry, None))
+                else:
+                    dic = self.read(path)
+                    result.append((self.make_entry(dic, path), dic))
+                    changed = True
+        if changed or len(result) != len(manifest):
+            self.write_manifest([entry for entry, dic in result])
+        return result
+
+    def mtime(self, bdipath):
+        'Modification time of dictionary file and its journal'
+        bdjpath = os.path.splitext(bdipath)[0] + os.path.extsep + 'bdj'
+        if os.path.exists(bdjpath):
+            return max(os.path.getmtime(bdipath), os.path.getmtime(bdjpath))
+        return os.path.getmtime(bdipath)
+
+    def make_entry(self, dic, path):
+        return OrderedDict([
+            ('file', os.path.basename(path)),
+            ('mtime', self.mtime(path)),
+            ('lang', dic.lang),
+            ('name', dic.name),
+            ('ver', dic.ver),
+            ('hash', dic.hash),
+            ('entries', len(dic)),
+            ])
+
+    def write_manifest(self, entries=None):
+        if entries is None:
+            entries = [d.entry for d in self.installed.values()]
+        try:
+            with open(self.manifestpath + '.part', 'wb') as f:
+                json.dump(entries, f, indent=1)
+            if os.path.exists(self.manifestpath):
+                os.unlink(self.manifestpath)
+            os.rename(self.manifestpath + '.part', self.manifestpath)
+        except EnvironmentError as err:
+            if self.verbose:
+                sys.stderr.write(u'Could not write dictionary manifest: {}\n'.format(err).encode('utf-8'))
+
+    @property
+    def manifest(self):
+        return [d.entry for d in self.installed.values()]
+
+    def selected(self, dic):
+        return (self.langs is None or dic.lang in self.langs) and (self.names is None or dic.name in self.names)
+
+    def install(self, lazy, replaces=None):
+        """Register installed dictionary, use it if selected. A new
+        version of installed dictionary replaces takes its place in the
+        manifest and lookup order, so that results do not depend on
+        whether it was updated in this run."""
+        if replaces is None:
+            self.installed[lazy.hash] = lazy
+        else:
+            self.installed = OrderedDict((lazy.hash, lazy) if sha == replaces else (sha, d) for sha, d in self.installed.iteritems())
+        if self.verbose:
+            sys.stderr.write(u'DICT {} ({} entries){}\n'.format(lazy, len(lazy), u'' if self.selected(lazy) else u' not selected').encode('utf-8'))
+        if self.selected(lazy):
+            if replaces in self.dictionary.ids:
+                self.dictionary.replace(replaces, lazy)
+            else:
+                self.dictionary.add(lazy)
+            self.notify()
+
+    def materialize(self, lazy):
+        'Read dictionary of a LazyDict from disk'
+        start = time.time()
+        dic = self.read(self.filepath(lazy))
+        if self.verbose:
+            sys.stderr.write(u'LOADED DICT {} in {:.3f}s\n'.format(dic, time.time() - start).encode('utf-8'))
+        return dic
+
+    def read(self, bdipath):
+        'Read dictionary, apply its journal of changes if any (see update)'
+        dic = self.read_base(bdipath)
+        bdjpath = os.path.splitext(bdipath)[0] + os.path.extsep + 'bdj'
+        if os.path.exists(bdjpath):
+            with open(bdjpath, 'rb') as bdj:
+                dic = formats.PatchedDict(dic, cPickle.load(bdj))
+        return dic
+
+    def read_base(self, bdipath):
+        bdxpath = os.path.splitext(bdipath)[0] + os.path.extsep + 'bdx'
+        if self.mapped and os.path.exists(bdxpath) and os.path.getmtime(bdxpath) >= os.path.getmtime(bdipath):
+            try:
+                return formats.MappedDict(bdxpath)
+            except (ValueError, KeyError, EnvironmentError):
+                pass
+        with open(bdipath, 'rb') as bdi:
+            dic = cPickle.load(bdi)
+        assert isinstance(dic, formats.DabaDict)
+        if self.mapped:
+            self.compile(dic, bdxpath)
+        return dic
+
+    def compile(self, dic, bdxpath=None):
+        try:
+            formats.MappedDictWriter(dic, bdxpath or self.mappedpath(dic)).write()
+        except EnvironmentError as err:
+            if self.verbose:
+                sys.stderr.write(u'Could not compile dictionary {}: {}\n'.format(dic, err).encode('utf-8'))
+
     def filepath(self, dic):
         return os.path.join(self.runtimedir, os.path.extsep.join(['-'.join([dic.lang, dic.name, dic.hash]), 'bdi']))
 
-    def load(self, dic):
-        if self.verbose:
-            sys.stderr.write(u'LOADED DICT {}\n'.format(dic).encode('utf-8'))
-        self.dictionary.add(dic)
+    def mappedpath(self, dic):
+        return os.path.join(self.runtimedir, os.path.extsep.join(['-'.join([dic.lang, dic.name, dic.hash]), 'bdx']))
+
+    def load(self, dic, replaces=None):
+        'Register dictionary just saved to runtimedir'
+        self.install(LazyDict(self, self.make_entry(dic, self.filepath(dic)), dic), replaces)
+        self.write_manifest()
+
+    def journalpath(self, dic):
+        return os.path.join(self.runtimedir, os.path.extsep.join(['-'.join([dic.lang, dic.name, dic.hash]), 'bdj']))
 
     def addfile(self, dictfile):
-        dic = formats.DictReader(dictfile).get()
-        if not dic.hash in self.dictionary.ids:
-            self.add(dic)
-            return dic.hash
+        reader = formats.DictReader(dictfile, store=False, records=True)
+        info = reader.get()
+        sha = formats.hash_records(reader.records)
+        if sha in self.installed:
+            return None
+        for d in self.installed.values():
+            if (d.lang, d.name) == (info.lang, info.name):
+                if self.update(d, info, reader.records, sha):
+                    return sha
+                break
+        dic = formats.DabaDict()
+        dic.lang, dic.name, dic.ver = info.lang, info.name, info.ver
+        for key, value in reader.records:
+            dic[key] = value
+        self.add(dic)
+        return dic.hash
+
+    def update(self, old, info, records, sha):
+        """Replace installed dictionary old with a new version of it,
+        given as DictReader records with hash sha, without rebuilding it.
+
+        Entries that differ are written to a journal (.bdj) kept along
+        with the files of the base dictionary, which are renamed after
+        the new hash. Returns False if changes exceed maxjournal of the
+        entries and the dictionary should be saved in full instead.
+        """
+        new = {}
+        for key, value in records:
+            new.setdefault(key, []).append(value)
+        current = old.dic
+        if isinstance(current, formats.PatchedDict):
+            base, changes = current.base, dict(current.changes)
+        else:
+            base, changes = current, {}
+        delta = {}
+        for key in current:
+            if key not in new:
+                delta[key] = None
+        for key, value in new.iteritems():
+            if key not in current or current[key] != value:
+                delta[key] = value
+        for key, value in delta.iteritems():
+            if value is None and key not in base:
+                changes.pop(key, None)
+            elif value is not None and key in base and base[key] == value:
+                changes.pop(key, None)
+            else:
+                changes[key] = value
+        if len(changes) > self.maxjournal * len(new):
+            return False
+        journal = {'base': base.hash, 'hash': sha, 'lang': info.lang, 'name': info.name, 'ver': info.ver, 'changes': changes}
+        dic = formats.PatchedDict(base, journal)
+        if self.verbose:
+            sys.stderr.write(u'DICT updated {} ({} entries changed)\n'.format(dic, len(delta)).encode('utf-8'))
+        with open(self.journalpath(dic) + '.part', 'wb') as o:
+            cPickle.dump(journal, o, cPickle.HIGHEST_PROTOCOL)
+        os.rename(self.journalpath(dic) + '.part', self.journalpath(dic))
+        os.rename(self.filepath(old), self.filepath(dic))
+        if os.path.exists(self.mappedpath(old)):
+            os.rename(self.mappedpath(old), self.mappedpath(dic))
+        if os.path.exists(self.journalpath(old)):
+            os.unlink(self.journalpath(old))
+        self.install(LazyDict(self, self.make_entry(dic, self.filepath(dic)), dic), old.hash)
+        self.write_manifest()
+        return True
 
     def add(self, dic):
-        for d in self.dictionary.dictlist:
+        for d in self.installed.values():
             if (dic.lang, dic.name) == (d.lang, d.name):
                 if not (dic.ver, dic.hash) == (d.ver, d.hash):
                     break
@@ -175,47 +611,80 @@ class DictLoader(object):
         else:
             self.save(dic)
             return dic.hash
-        self.remove(d.hash)
-        self.save(dic)
+        self.save(dic, replaces=d.hash)
+        if self.verbose:
+            sys.stderr.write(u'REMOVED DICT {}\n'.format(d).encode('utf-8'))
+        self.delete(d)
         return dic.hash
 
+    def set_priority(self, names):
+        'Look words up in the first matching dictionary only, listed names or hashes first'
+        hashes = []
+        for name in names:
+            found = [d.hash for d in self.installed.values() if name in (d.name, d.hash)]
+            found.extend(d.hash for d in self.dictionary.dictlist if name in (d.name, d.hash) and d.hash not in found)
+            if not found:
+                sys.stderr.write(u'No dictionary {} to give priority to\n'.format(name).encode('utf-8'))
+            hashes.extend(h for h in found if h not in hashes)
+        self.dictionary.set_priority(hashes)
+        self.notify()
+
     def remove(self, dicid):
-        for d in self.dictionary.dictlist:
-            if d.hash == dicid:
-                dic = d
-                break
+        dic = self.installed.pop(dicid)
         if self.verbose:
             sys.stderr.write(u'REMOVED DICT {}\n'.format(dic).encode('utf-8'))
-        self.dictionary.remove(dic.hash)
+        if dicid in self.dictionary.ids:
+            self.dictionary.remove(dicid)
+        self.delete(dic)
+        self.write_manifest()
+        self.notify()
+
+    def delete(self, dic):
+        'Close dictionary and delete its files'
+        dic.close()
         os.unlink(self.filepath(dic))
+        for path in [self.mappedpath(dic), self.journalpath(dic)]:
+            if os.path.exists(path):
+                os.unlink(path)
 
-    def save(self, dic):
+    def save(self, dic, replaces=None):
         if self.verbose:
             sys.stderr.write(u'DICT saved {}\n'.format(dic).encode('utf-8'))
-        self.load(dic)
         with open(self.filepath(dic), 'wb') as o:
             cPickle.dump(dic, o)
+        if self.mapped:
+            self.compile(dic)
+        self.load(dic, replaces)
 
 
-class GrammarLoader(object):
+class GrammarLoader(ResourceLoader):
     def __init__(self, runtimedir="./run"):
         self.runtimedir = runtimedir
         self.gramlist = []
         self.grammar = None
+        self.filehash = None
+        self.listeners = []
         root = os.getcwdu()
         for f in os.listdir(self.runtimedir):
             name, ext = os.path.splitext(f)
             if ext in ['.bgr']:
                 try:
                     with open(os.path.join(self.runtimedir, f), 'rb') as gram:
-                        g = cPickle.load(gram)
+                        data = gram.read()
+                    g = cPickle.loads(data)
                     assert isinstance(g, grammar.Grammar)
                     self.gramlist = [name]
                     self.grammar = g
+                    self.filehash = hashlib.sha1(data).hexdigest()
                 except (cPickle.UnpicklingError, ImportError, AssertionError):
                     #FIXME: raise an exception with error message
                     print "Invalid binary grammar file:", f
     
+    @property
+    def hash(self):
+        # grammars pickled by older versions do not keep source hash
+        return getattr(self.grammar, 'hash', self.filehash)
+
     def load(self, gramfile):
         self.grammar = grammar.Grammar(gramfile)
         self.gramlist = [os.path.basename(gramfile)]
@@ -226,114 +695,1245 @@ class GrammarLoader(object):
                 os.unlink(os.path.join(self.runtimedir, f))
         with open(os.path.join(self.runtimedir, os.path.extsep.join([os.path.basename(gramfile), 'bgr'])), 'wb') as o:
             cPickle.dump(self.grammar, o)
+        self.notify()
+
+
+class LemmaCache(object):
+    """ Bounded LRU mapping of word analyses, keeps usage statistics.
+    """
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if not self.maxsize:
+            return
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return OrderedDict([
+            ('size', len(self._data)),
+            ('maxsize', self.maxsize),
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('evictions', self.evictions),
+            ])
+
+
+class ConverterChain(object):
+    """ Orthographic conversion plugins applied in order.
+
+    Plugins are looked up once, results of each plugin are memoized per
+    input form. Keeps call counts and time spent in every plugin.
+
+    If the last plugin provides a grapheme lattice (see plugins) and a
+    lexicon is given, the lattice is walked against the lexicon and
+    only variants starting with a known stem are returned: a branch is
+    dropped as soon as its spelling is not a prefix of any key, unless
+    it already begins with a complete key (affixes and compounds are
+    left to the parser). All variants are returned if none is kept.
+    """
+    def __init__(self, names, memosize=100000, lexicon=None):
+        self.names = list(names)
+        # only modules of the plugins in use are imported
+        self.plugins = [load_plugin(name) for name in self.names]
+        self.memos = [LemmaCache(memosize) for name in self.names]
+        self.calls = [0] * len(self.names)
+        self.seconds = [0.0] * len(self.names)
+        # later plugins would change the spellings checked in lexicon
+        self.lexicon = lexicon if self.plugins and hasattr(self.plugins[-1], 'lattice') else None
+        self.candidates = 0
+        self.kept = 0
+
+    @property
+    def pruning(self):
+        return self.lexicon is not None
+
+    def clear(self):
+        'Drop memoized results, pruned ones depend on the lexicon'
+        for memo in self.memos:
+            memo.clear()
+
+    def _forms(self, spelling):
+        low = spelling.lower()
+        return set([low, detone(low), low.replace('-', '')])
+
+    def expand(self, lattice):
+        'lattice -> [variant] starting with a known stem, in convert order'
+        lexicon = self.lexicon
+        result = []
+        def walk(i, prefix, stem):
+            if i == len(lattice):
+                result.append(prefix)
+                return
+            for grapheme in lattice[i]:
+                spelling = prefix + grapheme
+                if stem:
+                    walk(i + 1, spelling, stem)
+                else:
+                    forms = self._forms(spelling)
+                    if any(lexicon.has_prefix(f) for f in forms):
+                        walk(i + 1, spelling, any(f in lexicon for f in forms))
+        walk(0, u'', False)
+        return result
+
+    def _convert_last(self, plugin, word):
+        if self.lexicon is None:
+            return plugin.convert(word)
+        lattice = plugin.lattice(word)
+        candidates = 1
+        for graphemes in lattice:
+            candidates *= len(graphemes)
+        if candidates == 1:
+            return plugin.convert(word)
+        results = self.expand(lattice)
+        self.candidates += candidates
+        self.kept += len(results)
+        return results or plugin.convert(word)
+
+    def convert(self, word):
+        'word -> [converted variants]'
+        wlist = [word]
+        for i, plugin in enumerate(self.plugins):
+            memo = self.memos[i]
+            converted = []
+            for w in wlist:
+                results = memo.get(w)
+                if results is None:
+                    start = time.time()
+                    if i == len(self.plugins) - 1:
+                        results = tuple(self._convert_last(plugin, w))
+                    else:
+                        results = tuple(plugin.convert(w))
+                    self.seconds[i] += time.time() - start
+                    self.calls[i] += 1
+                    memo.put(w, results)
+                converted.extend(results)
+            wlist = converted
+        return wlist
+
+    def variants(self, word):
+        'word -> distinct lowercased variants, in conversion order'
+        seen = set()
+        result = []
+        for w in self.convert(word):
+            w = w.lower()
+            if w not in seen:
+                seen.add(w)
+                result.append(w)
+        return result
+
+    def stats(self):
+        stats = OrderedDict((name, OrderedDict([
+            ('calls', self.calls[i]),
+            ('hits', self.memos[i].hits),
+            ('seconds', round(self.seconds[i], 3)),
+            ])) for i, name in enumerate(self.names))
+        if self.pruning:
+            stats[self.names[-1]]['candidates'] = self.candidates
+            stats[self.names[-1]]['kept'] = self.kept
+        return stats
+
+
+class PersistentCache(object):
+    """ On-disk store of word analyses (sqlite), shared between runs and
+    processes. Results are stored under the fingerprint of the resources
+    they were obtained with, so stale entries are never returned.
+    """
+    def __init__(self, filename, fingerprint):
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self._pending = []
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        import sqlite3
+        # sqlite connections should not be shared with forked processes
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.filename, timeout=60)
+            self._pid = os.getpid()
+            try:
+                self._conn.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.DatabaseError:
+                pass
+            self._conn.execute('CREATE TABLE IF NOT EXISTS analyses (fingerprint TEXT, form TEXT, result BLOB, PRIMARY KEY (fingerprint, form))')
+            self._conn.commit()
+        return self._conn
+
+    def get(self, form):
+        row = self.conn.execute('SELECT result FROM analyses WHERE fingerprint=? AND form=?', (self.fingerprint, form)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cPickle.loads(str(row[0]))
+
+    def put(self, form, value):
+        # buffer is sqlite3.Binary, sqlite3 is imported on first connection
+        self._pending.append((self.fingerprint, form, buffer(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))))
+        if len(self._pending) >= 1000:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO analyses VALUES (?, ?, ?)', self._pending)
+            self._pending = []
+
+    def stats(self):
+        return OrderedDict([
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ])
 
 
 
 class Processor(object):
-    def __init__(self, dictloader, grammarloader, converters=None, detone=False):
+    def __init__(self, dictloader, grammarloader, converters=None, detone=False, cachesize=100000, diskcache=None, profiler=None, prune=False, maxhypotheses=None, deadline=None, cutofflog=None):
         self.dictloader = dictloader
+        self.grammarloader = grammarloader
         self.converters = converters
+        self.detone = detone
+        self.limits = (maxhypotheses, deadline, cutofflog)
+        self.cache = LemmaCache(cachesize)
+        if converters:
+            self.chain = ConverterChain(converters, cachesize, lexicon=dictloader.dictionary if prune else None)
+        else:
+            self.chain = None
+        self.tokenizer = Tokenizer()
+        if diskcache:
+            self.diskcache = PersistentCache(diskcache, self.fingerprint)
+        else:
+            self.diskcache = None
+        self.profiler = profiler
         self.grammar = grammarloader.grammar
         self.parser = newmorph.Parser(self.dictloader.dictionary, self.grammar, detone=detone)
+        self.parser.set_profiler(profiler)
+        self.parser.set_limits(*self.limits)
+        dictloader.subscribe(self.reset)
+        grammarloader.subscribe(self.reset)
+
+    @property
+    def fingerprint(self):
+        'Hash of all the resources and options that determine parser output'
+        # dictionary hashes are str or unicode depending on where they were read
+        resources = ([str(sha) for sha in self.dictloader.dictionary.ids], self.grammarloader.hash, tuple(self.converters or ()), self.detone)
+        if self.dictloader.dictionary.firstmatch:
+            resources += (tuple(str(sha) for sha in self.dictloader.dictionary.priority),)
+        if self.chain and self.chain.pruning:
+            resources += ('pruned',)
+        if self.limits[:2] != (None, None):
+            resources += (self.limits[:2],)
+        return hashlib.sha1(repr(resources)).hexdigest()
+
+    def reset(self):
+        'Drop cached analyses and pick up a new grammar, if any'
+        if self.grammarloader.grammar is not self.grammar:
+            self.grammar = self.grammarloader.grammar
+            self.parser = newmorph.Parser(self.dictloader.dictionary, self.grammar, detone=self.detone)
+            self.parser.set_profiler(self.profiler)
+            self.parser.set_limits(*self.limits)
+        self.cache.clear()
+        if self.chain:
+            self.chain.clear()
+        if self.diskcache:
+            self.diskcache.fingerprint = self.fingerprint
+
+    def cachekey(self, word):
+        if self.converters:
+            return (word, tuple(self.converters), self.detone)
+        else:
+            return (word.lower(), (), self.detone)
+
+    def lemmatize(self, word):
+        'word -> (stage, [Gloss])'
+        stage, glosslist = self.lemmatize_many([word])[word]
+        return (stage, list(glosslist))
+
+    def lemmatize_many(self, words, pool=None, batchsize=50):
+        """[word] -> {word: (stage, (Gloss,))}
 
-    def parse(self, txt):
-        self.parsed = []
-        for para in txt:
-            par = []
-            tkz = Tokenizer()
-            for sent in tkz.split_sentences(tkz.tokenize(para)):
-                st = (''.join(t.value for t in sent), [])
-                par.append(st)
-                annot = st[1]
-                prevtoken = False
-                for token in sent:
-                    if token.type in ['Comment', 'Tag']:
-                        annot.append(formats.GlossToken((token.type, token.value)))
-                    elif token.type in ['Punct', 'SentPunct', 'Nonword']:
-                        annot.append(formats.GlossToken(('c', token.value)))
-                    elif token.type in ['Cardinal']:
-                        gloss = Gloss(token.value, ('num',), 'CARDINAL', ())
-                        annot.append(formats.GlossToken(('w', (token.value, 'tokenizer', [gloss]))))
-                    elif token.type in ['Word']:
-                        if self.converters:
-                            wlist = [token.value]
-                            for plugin in self.converters:
-                                converted = []
-                                for w in wlist:
-                                    for result in OrthographyConverter.get_plugins()[plugin].convert(w):
-                                        converted.append(result)
-                                wlist = converted
-                            converts = [self.parser.lemmatize(w.lower()) for w in wlist]
-                            successfull = [x[1] for x in filter(lambda s:s[0]>=0, converts)] or [c[1] for c in converts]
-                            stage = max([c[0] for c in converts])
-                            glosslist = []
-                            for gl in successfull:
-                                glosslist.extend(gl)
-                        else:
-                            stage, glosslist = self.parser.lemmatize(token.value.lower())
-
-                        # suggest proper name variant for capitalized words (not in sentence-initial position)
-                        if token.value.istitle() and prevtoken and 'n.prop' not in set([]).union(*[g.ps for g in glosslist]):
-                            propn = Gloss(token.value, ('n.prop',), token.value, ())
-                            glosslist.insert(0, propn)
-
-                        annot.append(formats.GlossToken(('w', (token.value, unicode(stage), glosslist))))
-                        prevtoken = True
-
-            self.parsed.append(par)
+        Every distinct word is looked up in the caches once, words not
+        found there are analysed together (see analyse_many).
+        """
+        result = {}
+        missing = OrderedDict()
+        for word in words:
+            if word in result or word in missing:
+                continue
+            key = self.cachekey(word)
+            cached = self.cache.get(key)
+            if cached is None and self.diskcache:
+                cached = self.diskcache.get(key[0])
+                if cached is not None:
+                    self.cache.put(key, cached)
+            if cached is None:
+                missing[word] = key
+            else:
+                result[word] = cached
+        if missing:
+            analyses = {}
+            todo = []
+            for word, key in missing.items():
+                if key not in analyses:
+                    analyses[key] = None
+                    todo.append(word)
+            for word, analysis in zip(todo, self.analyse_many(todo, pool, batchsize)):
+                key = missing[word]
+                analyses[key] = analysis
+                self.cache.put(key, analysis)
+                # cut off analyses depend on timing, try again next run
+                if self.diskcache and not newmorph.is_cutoff(analysis[0]):
+                    self.diskcache.put(key[0], analysis)
+            for word, key in missing.items():
+                result[word] = analyses[key]
+        return result
+
+    def analyse_many(self, words, pool=None, batchsize=50):
+        """[word] -> [(stage, (Gloss,))], no caching
+
+        Orthographic variants of all words are lemmatized together,
+        by the pool processes in batches of batchsize forms if pool
+        is given.
+        """
+        if self.chain:
+            variants = [self.chain.variants(word) for word in words]
+        else:
+            variants = [[word.lower()] for word in words]
+        forms = []
+        seen = set()
+        for vlist in variants:
+            for form in vlist:
+                if form not in seen:
+                    seen.add(form)
+                    forms.append(form)
+        if pool is None:
+            lemmas = self.parser.lemmatize_many(forms)
+        else:
+            lemmas = {}
+            for batch, profile in pool.imap(_lemmatize_forms, _chunks(forms, batchsize)):
+                if profile is not None:
+                    self.profiler.merge(profile)
+                lemmas.update(batch)
+        result = []
+        for vlist in variants:
+            converts = [lemmas[form] for form in vlist]
+            if len(converts) == 1:
+                stage, glosslist = converts[0]
+            else:
+                successfull = [x[1] for x in filter(lambda s:s[0]>=0, converts)] or [c[1] for c in converts]
+                stage = max([c[0] for c in converts])
+                glosslist = []
+                for gl in successfull:
+                    glosslist.extend(gl)
+            result.append((stage, tuple(glosslist)))
+        return result
+
+    def parse(self, txt, pool=None, batchsize=50):
+        self.parsed = self.parse_paras(list(txt), pool, batchsize)
+        if self.diskcache:
+            self.diskcache.flush()
         return self.parsed
 
+    def iterparse(self, txt, pool=None, chunksize=20, batchsize=50):
+        """Parse paragraphs lazily, yield them one at a time.
+
+        Paragraphs are read and analysed in chunks of chunksize (see
+        parse_paras). With a multiprocessing pool (see _init_worker),
+        the word forms of every chunk are lemmatized by the pool
+        processes in batches of batchsize.
+        """
+        for paras in _chunks(txt, chunksize):
+            for par in self.parse_paras(paras, pool, batchsize):
+                yield par
+        if self.diskcache:
+            self.diskcache.flush()
+
+    def tokenize_paras(self, paras):
+        '[paragraph text] -> ([[[Token]]] sentences of every paragraph, [word] to lemmatize)'
+        tkz = self.tokenizer
+        tokenized = [list(tkz.split_sentences(tkz.tokenize(para))) for para in paras]
+        words = [token.value for sents in tokenized for sent in sents for token in sent if token.type in ['Word']]
+        return tokenized, words
+
+    def parse_paras(self, paras, pool=None, batchsize=50):
+        """[paragraph text] -> [[(sentence text, [GlossToken])]]
+
+        Paragraphs are tokenized first, then all distinct words are
+        lemmatized at once and the tokens are assembled.
+        """
+        tokenized, words = self.tokenize_paras(paras)
+        lemmas = self.lemmatize_many(words, pool, batchsize)
+        return [self.assemble(sents, lemmas) for sents in tokenized]
+
+    def parse_para(self, para):
+        'paragraph text -> [(sentence text, [GlossToken])]'
+        return self.parse_paras([para])[0]
+
+    def assemble(self, sents, lemmas):
+        '[[Token]], {word: (stage, (Gloss,))} -> [(sentence text, [GlossToken])]'
+        par = []
+        for sent in sents:
+            st = (''.join(t.value for t in sent), [])
+            par.append(st)
+            annot = st[1]
+            prevtoken = False
+            for token in sent:
+                if token.type in ['Comment', 'Tag']:
+                    annot.append(formats.GlossToken((token.type, token.value)))
+                elif token.type in ['Punct', 'SentPunct', 'Nonword']:
+                    annot.append(formats.GlossToken(('c', token.value)))
+                elif token.type in ['Cardinal']:
+                    gloss = Gloss(token.value, ('num',), 'CARDINAL', ())
+                    annot.append(formats.GlossToken(('w', (token.value, 'tokenizer', [gloss]))))
+                elif token.type in ['Word']:
+                    stage, glosslist = lemmas[token.value]
+                    glosslist = list(glosslist)
+
+                    # suggest proper name variant for capitalized words (not in sentence-initial position)
+                    if token.value.istitle() and prevtoken and 'n.prop' not in set([]).union(*[g.ps for g in glosslist]):
+                        propn = Gloss(token.value, ('n.prop',), token.value, ())
+                        glosslist.insert(0, propn)
+
+                    annot.append(formats.GlossToken(('w', (token.value, unicode(stage), glosslist))))
+                    prevtoken = True
+        return par
+
+
+class FileMetrics(object):
+    """ Run metrics of one parsed file, see mparser --metrics.
+
+    Counts paragraphs, sentences and tokens of parsed paragraphs passed
+    to add_para, the histogram of word stages, unknown words (stage -1)
+    and analyses per word. Wall and CPU time and cache hits are taken
+    between construction and record(), or stop() if it was called;
+    add_wall adds time spent elsewhere, e.g. writing in another thread.
+    """
+    def __init__(self, infile, pp):
+        self.infile = infile
+        self.pp = pp
+        self.paragraphs = 0
+        self.sentences = 0
+        self.tokens = 0
+        self.words = 0
+        self.analyses = 0
+        self.stages = {}
+        self.start = self.snapshot()
+        self.end = None
+        self.extrawall = 0.0
+
+    def snapshot(self):
+        'Current (wall time, CPU time, cache counters, disk cache counters)'
+        pp = self.pp
+        return (time.time(), sum(os.times()[:2]), (pp.cache.hits, pp.cache.misses), (pp.diskcache.hits, pp.diskcache.misses) if pp.diskcache else None)
+
+    def stop(self):
+        'End of the measured work, later work in this process is not counted'
+        self.end = self.snapshot()
+
+    def add_wall(self, seconds):
+        self.extrawall += seconds
+
+    def add_para(self, par):
+        self.paragraphs += 1
+        for senttext, annot in par:
+            self.sentences += 1
+            for gt in annot:
+                self.tokens += 1
+                if gt.type == 'w':
+                    token, stage, glosslist = gt.value
+                    self.words += 1
+                    self.analyses += len(glosslist)
+                    self.stages[stage] = self.stages.get(stage, 0) + 1
+
+    def hitrate(self, start, end):
+        hits = end[0] - start[0]
+        misses = end[1] - start[1]
+        return OrderedDict([
+            ('hits', hits),
+            ('misses', misses),
+            ('hit_rate', round(float(hits) / (hits + misses), 4) if hits + misses else None),
+            ])
+
+    def record(self, error=None):
+        end = self.end or self.snapshot()
+        wall = end[0] - self.start[0] + self.extrawall
+        record = OrderedDict([
+            ('file', self.infile),
+            ('status', 'failed' if error else 'ok'),
+            ('paragraphs', self.paragraphs),
+            ('sentences', self.sentences),
+            ('tokens', self.tokens),
+            ('words', self.words),
+            ('wall', round(wall, 4)),
+            ('cpu', round(end[1] - self.start[1], 4)),
+            ('tokens_per_sec', round(self.tokens / wall, 1) if wall else None),
+            ('words_per_sec', round(self.words / wall, 1) if wall else None),
+            ('peak_rss_kb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None),
+            ('stages', OrderedDict(sorted(self.stages.items()))),
+            ('unknown_rate', round(float(self.stages.get(u'-1', 0)) / self.words, 4) if self.words else None),
+            ('analyses_per_word', round(float(self.analyses) / self.words, 3) if self.words else None),
+            ('cache', self.hitrate(self.start[2], end[2])),
+            ])
+        if self.start[3] is not None:
+            record['diskcache'] = self.hitrate(self.start[3], end[3])
+        return record
 
-def load_plugins():
-    plugindir = os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), 'plugins')
-    plugins = [x[:-3] for x in os.listdir(plugindir) if x.endswith('.py') and not x.startswith('__')]
-    for plugin in plugins:
-        mod = __import__('.'.join(['plugins', plugin]))
+
+STDIN = ('-', 'sys.stdin')
+STDOUT = ('-', 'sys.stdout')
+
+def file_sha1(filename, blocksize=1 << 16):
+    'SHA1 of file contents, read in blocks'
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def source_stamp(infile, pp):
+    'Metadata identifying the source file and the resources used to parse it'
+    stamp = OrderedDict([('_auto:fingerprint', pp.fingerprint)])
+    if infile not in STDIN:
+        stamp['_auto:source_mtime'] = repr(os.path.getmtime(infile))
+        stamp['_auto:source_sha1'] = file_sha1(infile)
+    return stamp
+
+def is_uptodate(infile, outfile, fingerprint):
+    """Check if outfile was parsed from the current infile with the
+    resources identified by fingerprint"""
+    if not os.path.exists(outfile):
+        return False
+    try:
+        metadata = formats.read_html_metadata(outfile)
+    except (EnvironmentError, SyntaxError):
+        return False
+    if metadata.get('_auto:fingerprint') != fingerprint:
+        return False
+    if metadata.get('_auto:source_mtime') == repr(os.path.getmtime(infile)):
+        return True
+    # source touched, but its contents may be the same
+    return metadata.get('_auto:source_sha1') == file_sha1(infile)
+
+def process_file(infile, outfile, pp, pool=None, chunksize=20, metrics=None, batchsize=50):
+    'Parse infile, write parsed html to outfile, count paragraphs in FileMetrics'
+    stamp = source_stamp(infile, pp)
+    if infile in STDIN or os.path.splitext(infile)[1] in ['.txt']:
+        # plain text is read, parsed and written paragraph by paragraph
+        reader = formats.TxtStreamReader(sys.stdin if infile in STDIN else infile)
+        metadata = OrderedDict(reader.metadata)
+        metadata.update(stamp)
+        with formats.HtmlStreamWriter(metadata, sys.stdout if outfile in STDOUT else outfile) as writer:
+            for par in pp.iterparse(reader, pool, chunksize, batchsize):
+                writer.write_para(par)
+                if metrics:
+                    metrics.add_para(par)
+    else:
+        io = formats.FileWrapper()
+        io.read(infile)
+        io.metadata.update(stamp)
+        parsed = pp.parse(io.para, pool, batchsize)
+        if metrics:
+            for par in parsed:
+                metrics.add_para(par)
+        io.write(outfile, parsed, parsed=True)
 
 def parse_file(infile, outfile, pp, args):
-    print 'Processing', infile
-    io = formats.FileWrapper()
-    io.read(infile)
-    io.write(outfile, pp.parse(io.para), parsed=True)
-    print 'Finished', outfile
+    # keep stdout clean when parsed text goes there
+    log = sys.stderr if outfile in STDOUT else sys.stdout
+    print >>log, 'Processing', infile
+    metrics = FileMetrics(infile, pp)
+    if args.jobs > 1:
+        # paragraphs of the file are spread over the pool processes
+        global _processor
+        _processor = pp
+        import multiprocessing
+        pool = multiprocessing.Pool(args.jobs, _init_worker, (args,))
+        try:
+            process_file(infile, outfile, pp, pool, args.chunksize, metrics, args.batchsize)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        process_file(infile, outfile, pp, chunksize=args.chunksize, metrics=metrics)
+    if args.metrics:
+        with open(args.metrics, 'ab') as out:
+            write_metrics(out, metrics.record())
+    print >>log, 'Finished', outfile
+
+
+def write_metrics(out, record):
+    'Append metrics record to JSON lines stream'
+    out.write(json.dumps(record))
+    out.write('\n')
+    out.flush()
+
+
+class CutoffLog(object):
+    """ Reports analyses cut off by parser limits (see
+    newmorph.CompiledPlan) as JSON lines appended to filename, or on
+    stderr. Pool processes open the file on their own.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.out = None
+        self.pid = None
+
+    def __call__(self, record):
+        if self.filename is None:
+            sys.stderr.write(u'CUTOFF {}\n'.format(u' '.join(u'{}={}'.format(k, v) for k, v in record.items())).encode('utf-8'))
+            return
+        if self.pid != os.getpid():
+            self.out = open(self.filename, 'ab')
+            self.pid = os.getpid()
+        write_metrics(self.out, record)
+
+
+def limit_options(args):
+    'Processor keyword arguments for parser limits given on command line'
+    if args.max_hypotheses is None and args.deadline is None:
+        return {}
+    return dict(maxhypotheses=args.max_hypotheses, deadline=args.deadline, cutofflog=CutoffLog(args.cutoff_log))
+
+
+def read_filelist(listfile):
+    'filename -> [(infile, outfile)]'
+    jobs = []
+    with open(listfile) as filelist:
+        for line in filelist:
+            infile = os.path.normpath(line.decode('utf-8').strip())
+            if os.path.exists(infile):
+                outfile = os.path.splitext(infile)[0] + '.pars.html'
+                jobs.append((infile, outfile))
+    return jobs
+
+
+# Processor used by the worker processes. It is set in the parent before
+# the pool is started, so that forked workers share loaded resources
+# copy-on-write instead of loading them once more.
+_processor = None
+
+# marks files not parsed again in parse_batch
+SKIPPED = object()
+
+def _init_worker(args):
+    global _processor
+    if _processor is None:
+        # no fork available (Windows): load resources in the worker
+        dl = DictLoader(langs=args.lang, names=args.dict_name)
+        if args.priority:
+            dl.set_priority(args.priority)
+        profiler = newmorph.StageProfiler(patterns=args.profile_patterns) if args.profile else None
+        _processor = Processor(dl, GrammarLoader(), converters=args.script, detone=args.detone, cachesize=args.cache_size, diskcache=args.disk_cache, prune=args.prune, profiler=profiler, **limit_options(args))
+    elif _processor.profiler is not None:
+        # counters inherited from the parent are reported by the parent
+        _processor.profiler.clear()
+
+def _parse_job(job):
+    'Parse single file in a worker, never raise -> (index, error, metrics record)'
+    index, infile, outfile = job
+    metrics = FileMetrics(infile, _processor)
+    try:
+        process_file(infile, outfile, _processor, metrics=metrics)
+    except Exception:
+        error = traceback.format_exc()
+        return (index, error, metrics.record(error))
+    return (index, None, metrics.record())
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _lemmatize_forms(forms):
+    'Lemmatize a batch of word forms in a pool process'
+    result = _processor.parser.lemmatize_many(forms)
+    profile = None
+    if _processor.profiler is not None:
+        profile = _processor.profiler.report()
+        _processor.profiler.clear()
+    return (result, profile)
+
+def _pool_job(job):
+    'Parse single file in a pool process, pass metrics and profile counters to the parent'
+    index, error, metrics = _parse_job(job)
+    profile = None
+    if _processor.profiler is not None:
+        profile = _processor.profiler.report()
+        _processor.profiler.clear()
+    return (index, error, metrics, profile)
+
+class StageQueue(object):
+    """ Bounded queue between two BatchPipeline stages, keeps depth and
+    blocking time statistics.
+    """
+    def __init__(self, maxsize):
+        self.queue = Queue.Queue(maxsize)
+        self.maxsize = maxsize
+        self.puts = 0
+        self.depthsum = 0
+        self.maxdepth = 0
+        self.putwait = 0.0
+        self.getwait = 0.0
+
+    def put(self, item):
+        if item is not None:
+            depth = self.queue.qsize()
+            self.puts += 1
+            self.depthsum += depth
+            self.maxdepth = max(self.maxdepth, depth)
+        start = time.time()
+        self.queue.put(item)
+        self.putwait += time.time() - start
+
+    def get(self):
+        start = time.time()
+        item = self.queue.get()
+        self.getwait += time.time() - start
+        return item
+
+    def stats(self):
+        return OrderedDict([
+            ('maxsize', self.maxsize),
+            ('items', self.puts),
+            ('avgdepth', round(float(self.depthsum) / self.puts, 2) if self.puts else 0),
+            ('maxdepth', self.maxdepth),
+            ('putwait', round(self.putwait, 3)),
+            ('getwait', round(self.getwait, 3)),
+            ])
+
+
+class BatchPipeline(object):
+    """ Parses files in three overlapping stages: a reader thread reads
+    and decodes input files, the calling thread analyses them and a
+    writer thread serializes and writes the output. Stages are connected
+    by queues of queuesize files, so that a fast stage waits for a slow
+    one (putwait) instead of filling memory.
+    """
+    def __init__(self, pp, queuesize=2):
+        self.pp = pp
+        self.parseq = StageQueue(queuesize)
+        self.writeq = StageQueue(queuesize)
+
+    def read(self, infile):
+        'infile -> (metadata, [paragraph text])'
+        stamp = source_stamp(infile, self.pp)
+        if os.path.splitext(infile)[1] in ['.txt']:
+            reader = formats.TxtStreamReader(infile)
+            metadata = OrderedDict(reader.metadata)
+            paras = list(reader)
+        else:
+            io = formats.FileWrapper()
+            io.read(infile)
+            metadata = io.metadata
+            paras = io.para
+        metadata.update(stamp)
+        return metadata, paras
+
+    def reader(self, jobs, todo):
+        for index in todo:
+            try:
+                metadata, paras = self.read(jobs[index][0])
+                self.parseq.put((index, metadata, paras, None))
+            except Exception:
+                self.parseq.put((index, None, None, traceback.format_exc()))
+        self.parseq.put(None)
+
+    def writer(self, jobs, callback):
+        while True:
+            item = self.writeq.get()
+            if item is None:
+                break
+            index, metadata, parsed, error, metrics = item
+            if error is None:
+                start = time.time()
+                try:
+                    with formats.HtmlStreamWriter(metadata, jobs[index][1]) as writer:
+                        for par in parsed:
+                            writer.write_para(par)
+                except Exception:
+                    error = traceback.format_exc()
+                # the calling thread is already parsing the next file,
+                # only wall time of writing can be told apart
+                metrics.add_wall(time.time() - start)
+            callback(index, error, metrics.record(error))
+
+    def run(self, jobs, todo, callback, started=None):
+        """Parse files jobs[i] (infile, outfile) for i in todo, in order,
+        started(i) is called from the calling thread before file i is
+        analysed, callback(i, error, metrics) from the writer thread when
+        it is done, error is None or a traceback string, metrics is
+        FileMetrics record: CPU time and cache counters of the analysis,
+        wall time of the analysis and writing"""
+        threads = [
+            threading.Thread(target=self.reader, args=(jobs, todo), name='reader'),
+            threading.Thread(target=self.writer, args=(jobs, callback), name='writer'),
+            ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        while True:
+            item = self.parseq.get()
+            if item is None:
+                break
+            index, metadata, paras, error = item
+            if started:
+                started(index)
+            parsed = None
+            metrics = FileMetrics(jobs[index][0], self.pp)
+            if error is None:
+                try:
+                    parsed = self.pp.parse(paras)
+                    for par in parsed:
+                        metrics.add_para(par)
+                except Exception:
+                    error = traceback.format_exc()
+            metrics.stop()
+            self.writeq.put((index, metadata, parsed, error, metrics))
+        self.writeq.put(None)
+        for t in threads:
+            t.join()
+        if self.pp.diskcache:
+            self.pp.diskcache.flush()
+
+    def stats(self):
+        return OrderedDict([('read', self.parseq.stats()), ('parse', self.writeq.stats())])
+
+
+def parse_batch(jobs, pp, args):
+    """Parse a list of (infile, outfile) pairs with args.jobs processes.
+
+    Files are scheduled largest first, a failed file is reported and
+    skipped. Unless args.force is set, files with up to date output are
+    not parsed again. Messages and the summary are printed in the list
+    order. Returns the list of failed input files.
+    """
+    global _processor
+    failed = []
+    skipped = []
+    if args.force:
+        todo = range(len(jobs))
+    else:
+        fingerprint = pp.fingerprint
+        todo = [i for i, (infile, outfile) in enumerate(jobs) if not is_uptodate(infile, outfile, fingerprint)]
+
+    def report(index, error, announced=False):
+        infile, outfile = jobs[index]
+        if error is SKIPPED:
+            print 'Up to date', infile
+            skipped.append(infile)
+            return
+        if not announced:
+            print 'Processing', infile
+        if error:
+            print 'Failed', infile
+            sys.stderr.write(error)
+            failed.append(infile)
+        else:
+            print 'Finished', outfile
+
+    metricsfile = open(args.metrics, 'ab') if args.metrics else None
+
+    # results of skipped files are known in advance
+    done = dict.fromkeys(range(len(jobs)), SKIPPED)
+    for index in todo:
+        del done[index]
+    nextindex = [0]
+    # files already reported as Processing
+    announced = set()
+
+    def flush():
+        while nextindex[0] in done:
+            report(nextindex[0], done.pop(nextindex[0]), nextindex[0] in announced)
+            nextindex[0] += 1
+
+    _processor = pp
+    flush()
+    if args.jobs > 1:
+        order = sorted(todo, key=lambda i: os.path.getsize(jobs[i][0]), reverse=True)
+        import multiprocessing
+        pool = multiprocessing.Pool(args.jobs, _init_worker, (args,))
+        for index, error, metrics, profile in pool.imap_unordered(_pool_job, [(i,) + jobs[i] for i in order]):
+            if profile is not None:
+                pp.profiler.merge(profile)
+            if metricsfile:
+                write_metrics(metricsfile, metrics)
+            done[index] = error
+            flush()
+        pool.close()
+        pool.join()
+    else:
+        pipeline = BatchPipeline(pp)
+        # messages are printed by this thread only, in list order: a file
+        # is announced before its analysis, once the files before it are
+        # written and reported
+        written = threading.Condition()
+
+        def started(index):
+            with written:
+                flush()
+                while nextindex[0] < index:
+                    written.wait()
+                    flush()
+            announced.add(index)
+            print 'Processing', jobs[index][0]
+
+        def finished(index, error, metrics):
+            with written:
+                if metricsfile:
+                    write_metrics(metricsfile, metrics)
+                done[index] = error
+                written.notify()
+        pipeline.run(jobs, todo, finished, started)
+        flush()
+        if args.verbose:
+            for stage, stats in pipeline.stats().items():
+                sys.stderr.write(u'PIPELINE {} {}\n'.format(stage, u' '.join(u'{}={}'.format(k, v) for k, v in stats.items())))
+
+    if metricsfile:
+        metricsfile.close()
+    print 'Processed {0} files, {1} failed, {2} up to date'.format(len(jobs) - len(skipped), len(failed), len(skipped))
+    for infile in failed:
+        print 'Failed:', infile
+    return failed
 
 
 def main():
-    
-    load_plugins() 
 
     aparser = argparse.ArgumentParser(description='Daba suite. Command line morphological parser.')
-    aparser.add_argument('-i', '--infile', help='Input file (.txt or .html)', default="sys.stdin")
-    aparser.add_argument('-o', '--outfile', help='Output file', default="sys.stdout")
-    aparser.add_argument('-s', '--script', action='append', choices=OrthographyConverter.get_plugins().keys(), default=None, help='Perform orthographic conversion operations (defined in plugins). Conversions will be applied in the order they appear on command line.')
+    aparser.add_argument('-i', '--infile', help='Input file (.txt or .html), - for stdin (default)', default="sys.stdin")
+    aparser.add_argument('-o', '--outfile', help='Output file, - for stdout (default)', default="sys.stdout")
+    aparser.add_argument('-s', '--script', action='append', choices=plugin_titles().keys(), default=None, help='Perform orthographic conversion operations (defined in plugins). Conversions will be applied in the order they appear on command line.')
+    aparser.add_argument('--prune', action='store_true', help='Analyse only those variants produced by an ambiguous conversion given last (e.g. bamlatinold) that start with a dictionary stem')
     aparser.add_argument("-d", "--dictionary", action="append", help="Toolbox dictionary file (may be added multiple times)")
+    aparser.add_argument("--lang", action="append", help="Use only installed dictionaries for language LANG (may be added multiple times)")
+    aparser.add_argument("--dict-name", action="append", help="Use only installed dictionaries named NAME (may be added multiple times)", metavar='NAME')
+    aparser.add_argument("-p", "--priority", action="append", help="Use only the first dictionary containing a word, trying dictionaries with the given NAME first (may be added multiple times)", metavar='NAME')
     aparser.add_argument("-g", "--grammar", help="Grammar specification file")
     aparser.add_argument("-n", "--noparse", action='store_true', help="Do not parse, only process resources")
     aparser.add_argument("-l", "--list", help="Read input filenames list from file")
+    aparser.add_argument("-f", "--force", action='store_true', help="Parse all files from the list, even if their output is up to date with the source and resources")
+    aparser.add_argument("-j", "--jobs", type=int, default=1, help="Number of parallel processes used to parse files from the list, or paragraphs of a single file (default: 1)")
+    aparser.add_argument("--chunksize", type=int, default=20, help="Number of paragraphs read and analysed together, their distinct words are lemmatized at once (default: 20)")
+    aparser.add_argument("--batchsize", type=int, default=50, help="Number of word forms sent to a process at once when parsing a single file with several processes (default: 50)")
     aparser.add_argument("-t", "--detone", action='store_true', help="Ignore tones in dictionary lookups")
     aparser.add_argument("-v", "--verbose", action='store_true', help="Print info messages on loaded dictionaries")
+    aparser.add_argument("--cache-size", type=int, default=100000, help="Maximum number of word analyses kept in memory cache, 0 disables caching (default: 100000)")
+    aparser.add_argument("--serve", nargs='?', const='localhost:8765', default=None, help="Keep running and answer parse requests over HTTP on host:port or a Unix socket path (default: localhost:8765), see mserver.py", metavar='ADDRESS')
+    aparser.add_argument("--metrics", help="Append a JSON line of run metrics (tokens, time, tokens/sec, stages, unknown words, cache hits...) for every parsed file to FILE", metavar='FILE')
+    aparser.add_argument("--profile", help="Write statistics on grammar stages (calls, time, hypotheses, resolved words) to FILE in JSON", metavar='FILE')
+    aparser.add_argument("--profile-patterns", action='store_true', help="With --profile, also count attempts, matches and surviving analyses of every grammar pattern and suggest firstmatch pattern order (slower), see ad-hoc/pattern-report.py")
+    aparser.add_argument("--max-hypotheses", type=int, default=None, help="Keep at most N hypotheses of a word after every grammar step, the first ones in grammar order; analyses cut off get stage ending in .cutoff", metavar='N')
+    aparser.add_argument("--deadline", type=float, default=None, help="Stop analysing a word after SECONDS and take the analyses found so far, marked with stage ending in .cutoff", metavar='SECONDS')
+    aparser.add_argument("--cutoff-log", help="Append a JSON line for every cutoff by --max-hypotheses or --deadline to FILE (default: print them on stderr)", metavar='FILE')
+    aparser.add_argument("--disk-cache", nargs='?', const=os.path.join('./run', 'lemmacache.sqlite'), default=None, help="Reuse word analyses between runs, stored in FILE (default: ./run/lemmacache.sqlite)", metavar='FILE')
     args = aparser.parse_args()
+    if args.profile_patterns and not args.profile:
+        aparser.error('--profile-patterns requires --profile')
 
-    dl = DictLoader(verbose=args.verbose)
+    dl = DictLoader(verbose=args.verbose, langs=args.lang, names=args.dict_name)
     gr = GrammarLoader()
     if args.dictionary:
         for dicfile in args.dictionary:
             dl.addfile(dicfile)
+    if args.priority:
+        dl.set_priority(args.priority)
     if args.grammar:
         gr.load(args.grammar)
-    if not args.noparse:
-        pp = Processor(dl, gr, converters=args.script, detone=args.detone)
+    if args.serve:
+        import mserver
+
+        def make_processor():
+            dl = DictLoader(verbose=args.verbose, langs=args.lang, names=args.dict_name)
+            if args.priority:
+                dl.set_priority(args.priority)
+            return Processor(dl, GrammarLoader(), converters=args.script, detone=args.detone, cachesize=args.cache_size, diskcache=args.disk_cache, prune=args.prune, **limit_options(args))
+        pp = Processor(dl, gr, converters=args.script, detone=args.detone, cachesize=args.cache_size, diskcache=args.disk_cache, prune=args.prune, **limit_options(args))
+        mserver.serve(args.serve, make_processor, processor=pp, runtimedir=dl.runtimedir, verbose=args.verbose)
+    elif not args.noparse:
+        profiler = newmorph.StageProfiler(patterns=args.profile_patterns) if args.profile else None
+        pp = Processor(dl, gr, converters=args.script, detone=args.detone, cachesize=args.cache_size, diskcache=args.disk_cache, prune=args.prune, profiler=profiler, **limit_options(args))
         if args.list:
-            with open(args.list) as filelist:
-                for line in filelist:
-                    infile = os.path.normpath(line.decode('utf-8').strip())
-                    if os.path.exists(infile):
-                        outfile = os.path.splitext(infile)[0] + '.pars.html'
-                        parse_file(infile, outfile, pp, args)
+            failed = parse_batch(read_filelist(args.list), pp, args)
         else:
+            failed = None
             parse_file(args.infile, args.outfile, pp, args)
+        if args.verbose and args.jobs <= 1:
+            sys.stderr.write(u'CACHE {}\n'.format(u' '.join(u'{}={}'.format(k, v) for k, v in pp.cache.stats().items())))
+            if pp.chain:
+                for name, stats in pp.chain.stats().items():
+                    sys.stderr.write(u'CONVERTER {} {}\n'.format(name, u' '.join(u'{}={}'.format(k, v) for k, v in stats.items())))
+            if pp.diskcache:
+                sys.stderr.write(u'DISK CACHE {}\n'.format(u' '.join(u'{}={}'.format(k, v) for k, v in pp.diskcache.stats().items())))
+        if profiler:
+            with open(args.profile, 'wb') as out:
+                json.dump(profiler.report(), out, indent=1)
+        if failed:
+            exit(1)
     exit(0)
 
+
+import unittest
+import shutil
+import tempfile
+import urllib2
+from StringIO import StringIO
+
+TEST_DICT = u"""\\lang bam
+\\name test
+\\ver 1
+
+\\lx muso
+\\ps n
+\\ge woman
+
+\\lx ce
+\\ps n
+\\ge man
+
+\\lx taa
+\\ps v
+\\ge go
+
+"""
+
+TEST_GRAMMAR = u"""plan
+for token:
+stage 0 add lookup
+return if parsed
+"""
+
+class ParserTestCase(unittest.TestCase):
+    'Runtime directory with a small dictionary and grammar'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.runtimedir = os.path.join(self.tmpdir, 'run')
+        os.mkdir(self.runtimedir)
+        self.write('dict.txt', TEST_DICT)
+        self.write('grammar.txt', TEST_GRAMMAR)
+        DictLoader(self.runtimedir).addfile(self.path('dict.txt'))
+        GrammarLoader(self.runtimedir).load(self.path('grammar.txt'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def write(self, name, text):
+        with open(self.path(name), 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+    def processor(self, **kwargs):
+        return Processor(DictLoader(self.runtimedir), GrammarLoader(self.runtimedir), **kwargs)
+
+
+class TestDiskCache(ParserTestCase):
+
+    def rows(self, filename):
+        import sqlite3
+        conn = sqlite3.connect(filename)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM analyses').fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_html_input_flushed(self):
+        self.write('text.txt', u'muso ni ce taara.\n\nce ma taa.\n')
+        process_file(self.path('text.txt'), self.path('text.html'), self.processor())
+        pp = self.processor(diskcache=self.path('cache.sqlite'))
+        process_file(self.path('text.html'), self.path('text.pars.html'), pp)
+        self.assertEqual(6, pp.diskcache.misses)
+        self.assertEqual(6, self.rows(self.path('cache.sqlite')))
+
+
+class TestDictUpdate(ParserTestCase):
+
+    def dictfile(self, name, glosses):
+        'Toolbox dictionary of nouns [(lx, ge)] -> file name'
+        lines = [u'\\lang bam', u'\\name ' + name, u'\\ver 1', u'']
+        for lx, ge in glosses:
+            lines.extend([u'\\lx ' + lx, u'\\ps n', u'\\ge ' + ge, u''])
+        self.write(name + '.txt', u'\n'.join(lines))
+        return self.path(name + '.txt')
+
+    def check_update(self, changed):
+        words = [(u'muso', u'woman-a')] + [(u'w{0}'.format(i), u'g{0}'.format(i)) for i in range(20)]
+        dl = DictLoader(self.runtimedir)
+        dl.addfile(self.dictfile('a', words))
+        dl.addfile(self.dictfile('b', [(u'muso', u'woman-b')]))
+        pp = self.processor()
+        pp.lemmatize(u'muso')
+        words[1:changed + 1] = [(lx, ge + u'x') for lx, ge in words[1:changed + 1]]
+        pp.dictloader.addfile(self.dictfile('a', words))
+        self.assertEqual(u'g0x', pp.lemmatize(u'w0')[1][0].gloss)
+        fresh = self.processor()
+        self.assertEqual(fresh.fingerprint, pp.fingerprint)
+        self.assertEqual(fresh.lemmatize(u'muso'), pp.lemmatize(u'muso'))
+        self.assertEqual(u'woman-a', pp.lemmatize(u'muso')[1][0].gloss)
+
+    def test_journal_keeps_order(self):
+        self.check_update(1)
+
+    def test_rebuild_keeps_order(self):
+        self.check_update(10)
+
+
+class TestMetrics(ParserTestCase):
+
+    def test_record(self):
+        self.write('text.txt', u'muso ni ce taara.\n\nce ma taa.\n')
+        pp = self.processor()
+        metrics = FileMetrics(self.path('text.txt'), pp)
+        process_file(self.path('text.txt'), self.path('text.html'), pp, metrics=metrics)
+        out = StringIO()
+        write_metrics(out, metrics.record())
+        write_metrics(out, FileMetrics(self.path('missing.txt'), pp).record('Traceback'))
+        lines = out.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        record = json.loads(lines[0])
+        self.assertEqual(['file', 'status', 'paragraphs', 'sentences', 'tokens', 'words', 'wall', 'cpu',
+            'tokens_per_sec', 'words_per_sec', 'peak_rss_kb', 'stages', 'unknown_rate', 'analyses_per_word', 'cache'],
+            list(json.loads(lines[0], object_pairs_hook=OrderedDict)))
+        self.assertEqual(('ok', 2, 2, 9, 7), (record['status'], record['paragraphs'], record['sentences'], record['tokens'], record['words']))
+        self.assertEqual({'0': 4, '-1': 3}, record['stages'])
+        # both rates come from the same unrounded wall time
+        self.assertTrue(record['tokens_per_sec'] > 0)
+        self.assertAlmostEqual(7 * record['tokens_per_sec'], 9 * record['words_per_sec'], delta=1)
+        self.assertEqual(6, record['cache']['misses'])
+        self.assertEqual('failed', json.loads(lines[1])['status'])
+
+
+class TestServer(ParserTestCase):
+
+    def setUp(self):
+        ParserTestCase.setUp(self)
+        import mserver
+        self.mserver = mserver
+        self.service = mserver.ParserService(self.processor, runtimedir=self.runtimedir, checkinterval=0)
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.service.thread.is_alive():
+            self.service.stop()
+        ParserTestCase.tearDown(self)
+
+    def serve(self):
+        self.service.start()
+        self.server = self.mserver.make_server('localhost:0', self.service)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def request(self, path, data=None):
+        'path, body -> (status, parsed JSON reply)'
+        url = 'http://localhost:{0}{1}'.format(self.server.server_address[1], path)
+        try:
+            reply = urllib2.urlopen(url, data)
+        except urllib2.HTTPError as err:
+            reply = err
+        return reply.getcode(), json.loads(reply.read())
+
+    def parse(self, request):
+        return self.request('/parse', json.dumps(request))
+
+    def glosses(self, token):
+        code, reply = self.parse({'tokens': [token]})
+        self.assertEqual(200, code)
+        return [g['gloss'] for g in reply['tokens'][0]['glosses']]
+
+    def test_parse(self):
+        self.serve()
+        code, reply = self.parse({'text': u'muso ni ce taara.\n\nce ma taa.\n'})
+        self.assertEqual(200, code)
+        self.assertEqual(2, len(reply['paragraphs']))
+        self.assertEqual([u'woman'], self.glosses(u'muso'))
+        code, stats = self.request('/stats')
+        self.assertEqual(200, code)
+        self.assertEqual((2, 0, 8), (stats['requests'], stats['errors'], stats['words']))
+        self.assertEqual(self.service.processor.fingerprint, stats['fingerprint'])
+
+    def test_batch(self):
+        pp = self.service.processor
+        calls = []
+
+        def lemmatize_many(words, *args):
+            calls.append(words)
+            return Processor.lemmatize_many(pp, words, *args)
+        pp.lemmatize_many = lemmatize_many
+        jobs = [self.service.submit(request) for request in
+                [{'text': u'muso ni ce.'}, {'tokens': [u'taa', u'muso']}, {'tokens': u'taa'}]]
+        self.service.start()
+        for job in jobs:
+            self.assertTrue(job.wait(10))
+        self.assertEqual(1, len(calls))
+        self.assertEqual([u'muso', u'ni', u'ce', u'taa', u'muso'], calls[0])
+        self.assertEqual([None, None, 400], [job.code for job in jobs])
+        self.assertEqual((1, 3, 1), (self.service.counters['batches'], self.service.counters['maxbatch'], self.service.counters['errors']))
+
+    def test_reload(self):
+        self.serve()
+        self.assertEqual([u''], self.glosses(u'jiri'))
+        self.write('tree.txt', u'\\lang bam\n\\name tree\n\\ver 1\n\n\\lx jiri\n\\ps n\n\\ge tree\n\n')
+        DictLoader(self.runtimedir).addfile(self.path('tree.txt'))
+        self.assertEqual([u'tree'], self.glosses(u'jiri'))
+        self.assertEqual(1, self.service.counters['reloads'])
+        code, reply = self.request('/reload', '')
+        self.assertEqual((200, 2), (code, reply['reloads']))
+
+    def test_errors(self):
+        self.serve()
+        self.assertEqual(400, self.request('/parse', '{"text": ')[0])
+        self.assertEqual(400, self.parse([u'muso'])[0])
+        self.assertEqual(400, self.parse({'text': u'muso', 'format': 'xml'})[0])
+        self.service.processor.tokenizer = None
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            code, reply = self.parse({'text': u'muso'})
+        finally:
+            stderr, sys.stderr = sys.stderr, stderr
+        self.assertEqual((500, u'Internal server error'), (code, reply['error']))
+        self.assertIn('Traceback', stderr.getvalue())
+        # the server keeps answering
+        self.assertEqual([u'woman'], self.glosses(u'muso'))
+        # invalid JSON is refused before reaching the worker
+        self.assertEqual(3, self.request('/stats')[1]['errors'])
+
+
 if __name__ == '__main__':
     main()
-
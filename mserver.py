@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Daba suite. Resident morphological parser.
+#
+# Keeps mparser.Processor loaded and answers parse requests over HTTP
+# on a localhost port or a Unix socket, see mparser.py --serve.
+#
+# GET  /health   {"status": "ok", ...}
+# GET  /stats    request, batch and cache counters
+# POST /parse    {"text": "..."} or {"tokens": ["word", ...]},
+#                optional "format": "json" (default) or "html"
+# POST /reload   reload resources from the runtime directory
+#
+# Resources are also reloaded when .bdi, .bdj or .bgr files change.
+
+import os
+import io
+import sys
+import json
+import time
+import signal
+import threading
+import traceback
+import Queue
+import BaseHTTPServer
+import SocketServer
+import formats
+import ntgloss
+from collections import OrderedDict
+
+
+def gloss_to_json(gloss):
+    return OrderedDict([
+        ('form', gloss.form),
+        ('ps', list(gloss.ps)),
+        ('gloss', gloss.gloss),
+        ('morphemes', [gloss_to_json(m) for m in gloss.morphemes]),
+        ])
+
+def token_to_json(gt):
+    if gt.type == 'w':
+        token, stage, glosslist = gt.value
+        return OrderedDict([
+            ('type', 'w'),
+            ('token', token),
+            ('stage', stage),
+            ('glosses', [gloss_to_json(g) for g in glosslist]),
+            ])
+    return OrderedDict([('type', gt.type), ('token', gt.value)])
+
+def para_to_json(para):
+    return [OrderedDict([('text', senttext), ('tokens', [token_to_json(gt) for gt in sentannot])]) for senttext, sentannot in para]
+
+def para_to_html(paras):
+    out = io.BytesIO()
+    writer = formats.HtmlStreamWriter({}, out)
+    for para in paras:
+        writer.write_para(para)
+    writer.close()
+    return out.getvalue()
+
+
+class RequestError(Exception):
+    pass
+
+
+class Job(object):
+    'Parse request waiting for the worker thread'
+    def __init__(self, request):
+        self.request = request
+        self.result = None
+        self.error = None
+        # HTTP status of the error reply
+        self.code = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+
+class ParserService(object):
+    """ Single worker thread owning the Processor.
+
+    Requests from concurrent clients are queued and handled in batches
+    of up to batchsize. Between batches the runtime directory is checked
+    (at most every checkinterval seconds) and the Processor is rebuilt
+    with make_processor when dictionaries or grammar changed, so that
+    requests already taken are finished with the old resources.
+    """
+    def __init__(self, make_processor, processor=None, runtimedir='./run', batchsize=64, checkinterval=1.0, verbose=False):
+        self.make_processor = make_processor
+        self.runtimedir = runtimedir
+        self.batchsize = batchsize
+        self.checkinterval = checkinterval
+        self.verbose = verbose
+        self.queue = Queue.Queue()
+        self.processor = processor or make_processor()
+        self.signature = self.resources_signature()
+        self.lastcheck = time.time()
+        self.reloadrequested = False
+        self.started = time.time()
+        self.counters = OrderedDict([
+            ('requests', 0),
+            ('errors', 0),
+            ('words', 0),
+            ('batches', 0),
+            ('maxbatch', 0),
+            ('reloads', 0),
+            ('busytime', 0.0),
+            ])
+        self.thread = threading.Thread(target=self.run, name='parser')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, request):
+        job = Job(request)
+        self.queue.put(job)
+        return job
+
+    def resources_signature(self):
+        sig = []
+        for f in sorted(os.listdir(self.runtimedir)):
+            if os.path.splitext(f)[1] in ['.bdi', '.bdj', '.bgr']:
+                st = os.stat(os.path.join(self.runtimedir, f))
+                sig.append((f, st.st_mtime, st.st_size))
+        return sig
+
+    def check_resources(self):
+        now = time.time()
+        if not self.reloadrequested and now - self.lastcheck < self.checkinterval:
+            return
+        self.lastcheck = now
+        signature = self.resources_signature()
+        if signature != self.signature or self.reloadrequested:
+            self.reloadrequested = False
+            try:
+                processor = self.make_processor()
+            except Exception:
+                # keep serving with loaded resources, retry on next check
+                sys.stderr.write(traceback.format_exc())
+                return
+            self.processor = processor
+            self.signature = signature
+            self.counters['reloads'] += 1
+            if self.verbose:
+                sys.stderr.write('RELOADED resources {0}\n'.format(processor.fingerprint))
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batchsize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in batch
+            batch = [job for job in batch if job is not None]
+            self.check_resources()
+            start = time.time()
+            self.handle(batch)
+            if self.processor.diskcache:
+                self.processor.diskcache.flush()
+            self.counters['busytime'] += time.time() - start
+            self.counters['requests'] += len(batch)
+            self.counters['batches'] += 1
+            self.counters['maxbatch'] = max(self.counters['maxbatch'], len(batch))
+            if stop:
+                break
+
+    def handle(self, batch):
+        """Answer a batch of jobs: requests are checked and tokenized,
+        the words of all of them are lemmatized in one call to
+        Processor.lemmatize_many, then every reply is assembled"""
+        pp = self.processor
+        prepared = []
+        for job in batch:
+            try:
+                words, render = self.prepare(job.request, pp)
+            except Exception as err:
+                self.fail(job, err)
+            else:
+                prepared.append((job, words, render))
+        try:
+            lemmas = pp.lemmatize_many([word for job, words, render in prepared for word in words])
+        except Exception as err:
+            for job, words, render in prepared:
+                self.fail(job, err)
+            return
+        for job, words, render in prepared:
+            try:
+                job.result = render(lemmas)
+            except Exception as err:
+                self.fail(job, err)
+            else:
+                job.done.set()
+
+    def fail(self, job, err):
+        'Answer job with error err, called from the except clause'
+        if isinstance(err, RequestError):
+            job.error = unicode(err)
+            job.code = 400
+        else:
+            # details go to the server log, not to the client
+            sys.stderr.write(traceback.format_exc())
+            job.error = u'Internal server error'
+            job.code = 500
+        self.counters['errors'] += 1
+        job.done.set()
+
+    def prepare(self, request, pp):
+        """request dict -> ([word], render), render takes lemmas of the
+        words {word: (stage, (Gloss,))} -> (content type, body)"""
+        if not isinstance(request, dict):
+            raise RequestError(u'Request must be a JSON object')
+        if request.get('reload'):
+            self.reloadrequested = True
+            self.check_resources()
+            reply = ('application/json', json.dumps({'reloads': self.counters['reloads'], 'fingerprint': self.processor.fingerprint}))
+            return [], lambda lemmas: reply
+        fmt = request.get('format', 'json')
+        if fmt not in ['json', 'html']:
+            raise RequestError(u'Unknown format: {0}'.format(fmt))
+        if 'tokens' in request:
+            tokens = request['tokens']
+            if fmt != 'json' or not isinstance(tokens, list) or not all(isinstance(t, basestring) for t in tokens):
+                raise RequestError(u'"tokens" must be a list of strings, JSON format only')
+            words = [formats.normalizeText(token) for token in tokens]
+
+            def render(lemmas):
+                result = []
+                for token, word in zip(tokens, words):
+                    stage, glosslist = lemmas[word]
+                    result.append(OrderedDict([('token', token), ('stage', unicode(stage)), ('glosses', [gloss_to_json(g) for g in glosslist])]))
+                self.counters['words'] += len(tokens)
+                return ('application/json', json.dumps({'tokens': result}))
+            return words, render
+        if 'text' in request:
+            text = request['text']
+            if not isinstance(text, basestring):
+                raise RequestError(u'"text" must be a string')
+            txt = formats.TxtStreamReader(io.BytesIO(text.encode('utf-8')), 'utf-8')
+            tokenized, words = pp.tokenize_paras(list(txt))
+
+            def render(lemmas):
+                paras = [pp.assemble(sents, lemmas) for sents in tokenized]
+                self.counters['words'] += len(words)
+                if fmt == 'html':
+                    return ('text/html; charset=utf-8', para_to_html(paras))
+                return ('application/json', json.dumps({'paragraphs': [para_to_json(para) for para in paras]}))
+            return words, render
+        raise RequestError(u'Request must have "text" or "tokens"')
+
+    def health(self):
+        return OrderedDict([
+            ('status', 'ok' if self.thread.is_alive() else 'stopped'),
+            ('uptime', time.time() - self.started),
+            ('queue', self.queue.qsize()),
+            ])
+
+    def stats(self):
+        pp = self.processor
+        stats = OrderedDict(self.counters)
+        stats['uptime'] = time.time() - self.started
+        stats['queue'] = self.queue.qsize()
+        stats['fingerprint'] = pp.fingerprint
+        stats['dictionaries'] = [unicode(d) for d in pp.dictloader.dictionary.dictlist]
+        stats['cache'] = pp.cache.stats()
+        if pp.diskcache:
+            stats['diskcache'] = pp.diskcache.stats()
+        stats['glosspool'] = ntgloss.glosspool.stats()
+        return stats
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = 'DabaParser/0.1'
+    protocol_version = 'HTTP/1.1'
+    timeout = 300
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.service.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def reply(self, code, body, ctype='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_error(self, code, message):
+        self.reply(code, json.dumps({'error': message}))
+
+    def do_GET(self):
+        service = self.server.service
+        path = self.path.split('?')[0]
+        if path == '/health':
+            self.reply(200, json.dumps(service.health()))
+        elif path == '/stats':
+            self.reply(200, json.dumps(service.stats()))
+        else:
+            self.reply_error(404, u'Not found: {0}'.format(path))
+
+    def do_POST(self):
+        service = self.server.service
+        path = self.path.split('?')[0]
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length)
+        if path == '/reload':
+            request = {'reload': True}
+        elif path == '/parse':
+            try:
+                request = json.loads(data.decode('utf-8'))
+            except ValueError as err:
+                self.reply_error(400, u'Invalid JSON: {0}'.format(err))
+                return
+        else:
+            self.reply_error(404, u'Not found: {0}'.format(path))
+            return
+        job = service.submit(request)
+        job.wait()
+        if job.error:
+            self.reply_error(job.code, job.error)
+        else:
+            ctype, body = job.result
+            self.reply(200, body, ctype)
+
+
+class HTTPParserServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixParserServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+
+
+def make_server(address, service):
+    """address is host:port, :port (localhost) or a Unix socket path"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        server = HTTPParserServer((host or 'localhost', int(port)), RequestHandler)
+    else:
+        server = UnixParserServer(address, RequestHandler)
+    server.service = service
+    return server
+
+def serve(address, make_processor, processor=None, runtimedir='./run', batchsize=64, verbose=False):
+    service = ParserService(make_processor, processor=processor, runtimedir=runtimedir, batchsize=batchsize, verbose=verbose)
+    service.start()
+    server = make_server(address, service)
+    sys.stderr.write('Serving on {0}\n'.format(address))
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(server, UnixParserServer) and os.path.exists(address):
+            os.unlink(address)
+        service.stop()
@@ -2,7 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import re
-from ntgloss import Gloss, CompactGloss, emptyGloss, Pattern, Dictionary
+import time
+import itertools
+import sre_parse
+from sre_constants import AT, AT_END, AT_END_STRING, LITERAL, SUBPATTERN
+from collections import OrderedDict, defaultdict
+from ntgloss import Gloss, CompactGloss, emptyGloss, Pattern, Dictionary, glosspool
 from orthography import detone
 
 
@@ -10,31 +15,59 @@ def nullgloss(word):
     'str -> Gloss'
     return Gloss(word, (), '', ())
 
-def parse_composite(form, gdict, numparts):
-    'Str, Dictionary, Int -> [[Str]]'
-    def parse_composite_aux(form, gdict, num, result):
-        if not num:
-            if form:
-                return []
+class CompositeLattice(object):
+    """ Splits of a form into dictionary words (see parse_composite).
+
+    Dictionary prefixes of every suffix of the form are queried once,
+    on demand, and kept by offset. Whether the rest of the form from an
+    offset can be split into a given number of words is memoized as
+    well, so that dead branches are not explored again.
+    """
+    def __init__(self, form, gdict):
+        self.form = form
+        self.gdict = gdict
+        self._prefixes = {}
+        self._complete = {}
+
+    def prefixes(self, offset):
+        'offset -> [end] of dictionary words starting at offset, longest first'
+        try:
+            return self._prefixes[offset]
+        except KeyError:
+            ends = [offset + len(p) for p in self.gdict.iter_prefixes(self.form[offset:])][::-1]
+            self._prefixes[offset] = ends
+            return ends
+
+    def complete(self, offset, numparts):
+        'Check if form from offset splits into exactly numparts words'
+        key = (offset, numparts)
+        if key not in self._complete:
+            if not numparts:
+                self._complete[key] = offset == len(self.form)
             else:
-                return result
-        else:
-            prefixes = [p for p in gdict.iter_prefixes(form)][::-1]
-            if not prefixes:
-                return []
+                self._complete[key] = any(self.complete(end, numparts - 1) for end in self.prefixes(offset))
+        return self._complete[key]
+
+    def splits(self, numparts, offset=0):
+        'Lazily yield [Str] splits into numparts words'
+        if not numparts or not self.complete(offset, numparts):
+            return
+        for end in self.prefixes(offset):
+            if numparts == 1:
+                if end == len(self.form):
+                    yield [self.form[offset:end]]
             else:
-                out = []
-                for pref in prefixes:
-                    parsed = parse_composite_aux(form[len(pref):], gdict, num-1, result+[pref])
-                    if parsed:
-                        if isinstance(parsed[0], list):
-                            for i in parsed:
-                                out.append(i)
-                        else:
-                            out.append(parsed)
-                return out
+                for rest in self.splits(numparts - 1, end):
+                    yield [self.form[offset:end]] + rest
+
 
-    return [r for r in parse_composite_aux(form, gdict, numparts, []) if r]
+def iter_composite(form, gdict, numparts):
+    'Str, Dictionary, Int -> iter([Str]), lazy parse_composite'
+    return CompositeLattice(form, gdict).splits(numparts)
+
+def parse_composite(form, gdict, numparts, limit=None):
+    'Str, Dictionary, Int, Maybe(Int) -> [[Str]], at most limit splits'
+    return list(itertools.islice(iter_composite(form, gdict, numparts), limit))
 
 
 unfold = lambda l: [j for i in l for j in i]
@@ -63,12 +96,131 @@ def f_apply(func, *args):
 
 #def f_filter(func, *args):
 
+def _literal_suffix(items):
+    'sre_parse items -> (literal they must end with, whether they are all literal)'
+    suffix = u''
+    for op, av in reversed(items):
+        if op == LITERAL:
+            suffix = unichr(av) + suffix
+        elif op == SUBPATTERN:
+            inner, whole = _literal_suffix(av[-1])
+            suffix = inner + suffix
+            if not whole:
+                return suffix, False
+        else:
+            return suffix, False
+    return suffix, True
+
+def form_constraint(form):
+    '''Pattern form (string or regex) -> Maybe((suffix, minlen)): literal
+    suffix and minimal length of any form it matches'''
+    if isinstance(form, basestring):
+        return (form, len(form))
+    try:
+        flags = form.flags
+        pattern = form.pattern
+    except AttributeError:
+        return None
+    if flags & (re.IGNORECASE | re.MULTILINE):
+        return None
+    if isinstance(pattern, str) and not all(ord(c) < 128 for c in pattern):
+        return None
+    try:
+        items = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+    minlen = items.getwidth()[0]
+    items = list(items)
+    if items and items[-1] in [(AT, AT_END), (AT, AT_END_STRING)]:
+        return (_literal_suffix(items[:-1])[0], minlen)
+    return (u'', minlen)
+
+
+class PatternIndex(object):
+    """ Patterns of a grammar section indexed by the literal suffix and
+    minimal length of the forms they select (see form_constraint).
+
+    Pattern.matches requires the first morpheme of the select gloss to
+    match some morpheme of a hypothesis (the hypothesis itself if it
+    has no morphemes), or the select form to match the form of the
+    hypothesis. candidates returns, in grammar order, only the patterns
+    that pass this check on suffix and length: the others would be
+    rejected by Pattern.apply anyway. Valid for formal parsing (parse)
+    only, decompose splits forms before matching.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.constraints = {}
+        self.always = []
+        self.bysuffix = {}
+        for i, pattern in enumerate(self.patterns):
+            select = pattern.select
+            if select.morphemes:
+                where, form = 'morph', select.morphemes[0].form
+            else:
+                where, form = 'form', select.form
+            constraint = form_constraint(form) if form else None
+            if constraint is not None:
+                self.constraints[id(pattern)] = (where,) + constraint
+            if constraint is None or not constraint[0]:
+                self.always.append(i)
+            else:
+                self.bysuffix.setdefault((where, constraint[0]), []).append(i)
+        self.lengths = sorted(set(len(suffix) for where, suffix in self.bysuffix))
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _forms(self, gloss):
+        'Gloss -> Maybe({where: [form]}), None if forms can not be checked'
+        forms = {'morph': [m.form for m in gloss.morphemes] if gloss.morphemes else [gloss.form], 'form': [gloss.form]}
+        for form in forms['morph'] + forms['form']:
+            # $ also matches before a trailing newline
+            if not isinstance(form, basestring) or form.endswith('\n'):
+                return None
+        return forms
+
+    def _accepts(self, pattern, forms):
+        constraint = self.constraints.get(id(pattern))
+        if constraint is None:
+            return True
+        where, suffix, minlen = constraint
+        return any(len(form) >= minlen and form.endswith(suffix) for form in forms[where])
+
+    def accepts(self, pattern, gloss):
+        'Check if pattern may match gloss'
+        forms = self._forms(gloss)
+        return forms is None or self._accepts(pattern, forms)
+
+    def candidates(self, gloss):
+        'Gloss -> [Pattern] that may match it, in grammar order'
+        forms = self._forms(gloss)
+        if forms is None:
+            return self.patterns
+        found = set(self.always)
+        bysuffix = self.bysuffix
+        for where, formlist in forms.items():
+            for form in formlist:
+                for n in self.lengths:
+                    found.update(bysuffix.get((where, form[-n:]), ()))
+        patterns = self.patterns
+        return [patterns[i] for i in sorted(found) if self._accepts(patterns[i], forms)]
+
+
 def parallel(func, patterns):
     '(Gloss, Pattern -> Maybe(Gloss)) -> (Gloss -> Maybe([Gloss]))'
+    if isinstance(patterns, PatternIndex):
+        return lambda gloss: unfold(filter(None, [func(p, gloss) for p in patterns.candidates(gloss)]))
     return lambda gloss: unfold(filter(None, [func(p, gloss) for p in patterns]))
     
 def sequential(func, patterns):
     '(Gloss, Pattern -> Maybe(Gloss) -> (Gloss -> Maybe([Gloss]))'
+    # hypothesis changes as patterns apply, check them one by one
+    accepts = patterns.accepts if isinstance(patterns, PatternIndex) else None
+    patterns = list(patterns)
     def seq(p, gl, match=False):
         '(Pattern, Gloss -> Maybe(Gloss)), [Pattern], Gloss -> Gloss'
         if not p:
@@ -77,7 +229,10 @@ def sequential(func, patterns):
             else:
                 return None
         else:
-            applied = func(p[0], gl[0]) 
+            if accepts is None or accepts(p[0], gl[0]):
+                applied = func(p[0], gl[0])
+            else:
+                applied = None
             if applied:
                 # FIXME: here we assume func always returns list of len==1
                 if match:
@@ -103,10 +258,460 @@ def firstmatch(func, patterns):
             else:
                 return seq(p[1:], gl)
 
+    if isinstance(patterns, PatternIndex):
+        return lambda gloss: seq(patterns.candidates(gloss), [gloss])
     return lambda gloss: seq(patterns, [gloss])
 
 
+class StageProfiler(object):
+    """ Per-stage statistics of Parser.lemmatize, see Parser.set_profiler.
+
+    For each stage of the processing plan records calls, time spent,
+    hypotheses in and out, how many times the stage changed hypotheses,
+    how many words got their final analysis from it (resolved) and
+    hypotheses left once duplicates are removed (unique). With patterns,
+    also keeps statistics of every pattern in PatternProfiler.
+    """
+    fields = ('calls', 'seconds', 'hypotheses_in', 'hypotheses_out', 'changed', 'resolved', 'unique')
+
+    def __init__(self, patterns=False):
+        self.stages = OrderedDict()
+        self.patterns = PatternProfiler() if patterns else None
+        self.clear()
+
+    def clear(self):
+        # counters are reset in place, instrumented stages keep them
+        for counters in self.stages.values():
+            counters[:] = [0, 0.0, 0, 0, 0, 0, 0]
+        if self.patterns is not None:
+            self.patterns.clear()
+        self.words = 0
+        self.unresolved = 0
+        self.seconds = 0.0
+        self.last = None
+
+    def record(self, index, step, stagestr):
+        'stage description -> list of counters'
+        if isinstance(stagestr, (list, tuple)):
+            stagestr = u' '.join(stagestr)
+        key = (index, unicode(step), stagestr)
+        if key not in self.stages:
+            self.stages[key] = [0, 0.0, 0, 0, 0, 0, 0]
+        return self.stages[key]
+
+    def wrap(self, index, step, stagestr, stageparser):
+        'Instrumented stage function'
+        counters = self.record(index, step, stagestr)
+        clock = time.time
+        def profiled(parses):
+            start = clock()
+            result = stageparser(parses)
+            counters[1] += clock() - start
+            counters[0] += 1
+            counters[2] += len(parses)
+            counters[3] += len(result)
+            if step != 'return' and not result == parses:
+                counters[4] += 1
+                self.last = counters
+            return result
+        return profiled
+
+    def report(self):
+        stages = []
+        for (index, step, stagestr), counters in self.stages.items():
+            stat = OrderedDict([('index', index), ('step', step), ('stage', stagestr)])
+            stat.update(zip(self.fields, counters))
+            stat['seconds'] = round(stat['seconds'], 6)
+            stages.append(stat)
+        report = OrderedDict([
+            ('words', self.words),
+            ('seconds', round(self.seconds, 6)),
+            ('unresolved', self.unresolved),
+            ('stages', stages),
+            ])
+        if self.patterns is not None:
+            report['patterns'] = self.patterns.report()
+        return report
+
+    def merge(self, report):
+        'Add counters from a report (e.g. made in another process)'
+        self.words += report['words']
+        self.seconds += report['seconds']
+        self.unresolved += report['unresolved']
+        for stat in report['stages']:
+            counters = self.record(stat['index'], stat['step'], stat['stage'])
+            for i, field in enumerate(self.fields):
+                counters[i] += stat.get(field, 0)
+        if self.patterns is not None and 'patterns' in report:
+            self.patterns.merge(report['patterns'])
+
+
+class PatternProfiler(object):
+    """ Per-pattern statistics of grammar sections over a corpus, kept
+    by StageProfiler(patterns=True).
+
+    For each pattern of a section used in the plan records attempts,
+    matches, analyses produced, time spent, words it matched in and
+    words whose final parsed analyses come from its analyses (survived):
+    analyses are traced through the steps of the plan, those of the
+    other matched words were all dropped by return if parsed.
+
+    firstmatch stops at the first matching pattern, so all candidates
+    are tried there to record which patterns match the same hypothesis
+    (overlaps); attempts count those up to the first match only.
+    Sections are keyed by (section, combinator, func).
+    """
+    fields = ('attempts', 'matches', 'produced', 'seconds', 'words', 'survived')
+
+    def __init__(self):
+        self.sections = OrderedDict()
+        self.clear()
+
+    def clear(self):
+        # counters are reset in place, instrumented functions keep them
+        for record in self.sections.values():
+            for counters in record['counters']:
+                counters[:] = [0, 0, 0, 0.0, 0, 0]
+            record['overlaps'].clear()
+        self.origin = {}
+        self.matched = {}
+
+    def section(self, name, combinator, func, labels):
+        'section description, pattern labels -> record of counters'
+        key = (name, combinator, func)
+        if key not in self.sections:
+            self.sections[key] = {
+                    'patterns': list(labels),
+                    'counters': [[0, 0, 0, 0.0, 0, 0] for label in labels],
+                    'overlaps': defaultdict(int),
+                    }
+        return self.sections[key]
+
+    def begin(self):
+        'Start tracing analyses of a word'
+        self.origin = {}
+        self.matched = {}
+
+    def end(self, result):
+        'Count matched and surviving patterns of a word given its analyses'
+        survived = set()
+        for g in result:
+            if parsed(g):
+                survived.update(self.origin.get(g, ()))
+        for key, counters in self.matched.items():
+            counters[4] += 1
+            if key in survived:
+                counters[5] += 1
+
+    def tag(self, result, gloss, counters):
+        'Mark analyses made from gloss by the pattern of counters'
+        origin = self.origin
+        tags = origin.get(gloss, frozenset()) | frozenset([id(counters)])
+        for g in result:
+            origin[g] = origin.get(g, frozenset()) | tags
+        self.matched[id(counters)] = counters
+
+    def trace(self, func):
+        '(Gloss -> Maybe([Gloss])) step function passing marks to its results'
+        def traced(gloss):
+            result = func(gloss)
+            if result:
+                tags = self.origin.get(gloss)
+                if tags:
+                    for g in result:
+                        self.origin[g] = self.origin.get(g, frozenset()) | tags
+            return result
+        return traced
+
+    def combine(self, name, combinator, funcname, func, patterns):
+        'Instrumented combinator(func, patterns) of section name'
+        record = self.section(name, combinator.__name__, funcname, [u'{0} | {1}'.format(unicode(p.select), unicode(p.mark)) for p in patterns])
+        index = dict((id(p), i) for i, p in enumerate(patterns))
+        allcounters = record['counters']
+        clock = time.time
+        if combinator is firstmatch:
+            overlaps = record['overlaps']
+            def first(gloss):
+                candidates = patterns.candidates(gloss) if isinstance(patterns, PatternIndex) else list(patterns)
+                result = None
+                matching = []
+                for p in candidates:
+                    start = clock()
+                    applied = func(p, gloss)
+                    if result is None:
+                        counters = allcounters[index[id(p)]]
+                        counters[0] += 1
+                        counters[3] += clock() - start
+                        if applied:
+                            counters[1] += 1
+                            counters[2] += len(applied)
+                            self.tag(applied, gloss, counters)
+                            result = applied
+                    if applied:
+                        matching.append(index[id(p)])
+                overlaps[(tuple(index[id(p)] for p in candidates), tuple(matching))] += 1
+                return result
+            return first
+        def profiled(pattern, gloss):
+            counters = allcounters[index[id(pattern)]]
+            start = clock()
+            result = func(pattern, gloss)
+            counters[3] += clock() - start
+            counters[0] += 1
+            if result:
+                counters[1] += 1
+                counters[2] += len(result)
+                self.tag(result, gloss, counters)
+            return result
+        return combinator(profiled, patterns)
+
+    @staticmethod
+    def firstmatch_attempts(order, overlaps):
+        'pattern order, {(candidates, matching): count} -> attempts of firstmatch'
+        position = dict((i, n) for n, i in enumerate(order))
+        attempts = 0
+        for (candidates, matching), count in overlaps.items():
+            candidates = sorted(candidates, key=position.get)
+            if matching:
+                first = min(matching, key=position.get)
+                attempts += (candidates.index(first) + 1) * count
+            else:
+                attempts += len(candidates) * count
+        return attempts
+
+    @staticmethod
+    def suggest_order(counters, overlaps):
+        """ Order of firstmatch patterns trying the ones that match most
+        often first, with the same result: a pattern that matched a
+        hypothesis stays before the others that matched it as well.
+        """
+        before = defaultdict(set)
+        for candidates, matching in overlaps:
+            for i in matching[1:]:
+                before[i].add(matching[0])
+        order = []
+        left = range(len(counters))
+        while left:
+            ready = [i for i in left if not before[i] - set(order)]
+            best = max(ready, key=lambda i: (counters[i][1], -i))
+            order.append(best)
+            left.remove(best)
+        return order
+
+    def report(self):
+        sections = []
+        for (name, combinator, func), record in self.sections.items():
+            counters = record['counters']
+            patterns = []
+            for i, (label, c) in enumerate(zip(record['patterns'], counters)):
+                stat = OrderedDict([('index', i), ('pattern', label)])
+                stat.update(zip(self.fields, c))
+                stat['seconds'] = round(stat['seconds'], 6)
+                patterns.append(stat)
+            stat = OrderedDict([
+                ('section', name),
+                ('combinator', combinator),
+                ('func', func),
+                ('patterns', patterns),
+                ('never', [i for i, c in enumerate(counters) if not c[1]]),
+                ])
+            if combinator == 'firstmatch':
+                overlaps = record['overlaps']
+                order = self.suggest_order(counters, overlaps)
+                stat['attempts'] = self.firstmatch_attempts(range(len(counters)), overlaps)
+                stat['suggested_order'] = order
+                stat['suggested_attempts'] = self.firstmatch_attempts(order, overlaps)
+                stat['overlaps'] = [[list(candidates), list(matching), count] for (candidates, matching), count in overlaps.items()]
+            sections.append(stat)
+        return sections
+
+    def merge(self, report):
+        'Add counters from a report (e.g. made in another process)'
+        for stat in report:
+            record = self.section(stat['section'], stat['combinator'], stat['func'], [p['pattern'] for p in stat['patterns']])
+            for counters, p in zip(record['counters'], stat['patterns']):
+                for i, field in enumerate(self.fields):
+                    counters[i] += p[field]
+            for candidates, matching, count in stat.get('overlaps', ()):
+                record['overlaps'][(tuple(candidates), tuple(matching))] += count
+
+
+CUTOFF = u'cutoff'
+
+def cutoff_stage(stage):
+    'Stage of analyses returned when a plan is cut off by its limits'
+    return u'{0}.{1}'.format(stage, CUTOFF)
+
+def is_cutoff(stage):
+    return isinstance(stage, basestring) and stage.endswith(u'.' + CUTOFF)
+
+def keep_best(hypotheses, n):
+    """[Gloss], int -> first n hypotheses, parsed ones before the rest
+
+    Order of hypotheses is kept: earlier ones before those added by the
+    last step, results of earlier patterns before later ones.
+    """
+    ranked = sorted(range(len(hypotheses)), key=lambda i: not parsed(hypotheses[i]))
+    return [hypotheses[i] for i in sorted(ranked[:n])]
+
+def unique(seq):
+    'Drop duplicates, keep first occurrences in order'
+    seen = set()
+    seen_add = seen.add
+    return [x for x in seq if not (x in seen or seen_add(x))]
+
+
+class Deadline(Exception):
+    pass
+
+
+class CompiledPlan(object):
+    """ Token processing plan of a grammar as a flat list of steps.
+
+    Each step is (stage, kind, func, stagestr), where func takes a
+    single hypothesis (Gloss) and kind is one of:
+
+    add     keep hypotheses, add results of func for each of them
+    apply   replace each hypothesis with results of func, if any
+    return  finish with hypotheses satisfying func, if there are any
+    call    func takes and returns the whole list of hypotheses
+
+    Duplicate hypotheses are dropped after every step, keeping first
+    occurrences: results are the same as with duplicates dropped at the
+    end only, but later steps do not process them again. Counts the
+    hypotheses every step produced and kept.
+
+    Limits, None for no limit:
+
+    maxhypotheses  hypotheses kept after a step, see keep_best
+    deadline       seconds per word, checked before a step processes
+                   every hypothesis; when it is over, hypotheses before
+                   the step are returned, only parsed ones if any
+
+    Analyses of a word that hit a limit get stage marked by
+    cutoff_stage, oncutoff is called with a record of every cutoff.
+    """
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self.produced = [0] * len(self.steps)
+        self.kept = [0] * len(self.steps)
+        self.cutoffs = [0] * len(self.steps)
+        self.maxhypotheses = None
+        self.deadline = None
+        self.oncutoff = None
+        self.expires = None
+        self.instrument(None)
+
+    @staticmethod
+    def runner(kind, func):
+        '[Gloss] -> [Gloss] function for a step'
+        if kind == 'add':
+            return lambda parses: parses + [g for p in parses for g in (func(p) or ())]
+        elif kind == 'apply':
+            return lambda parses: [g for p in parses for g in (func(p) or [p])]
+        elif kind == 'return':
+            return lambda parses: [p for p in parses if func(p)]
+        return func
+
+    def checked(self, func):
+        'func raising Deadline when the current word is out of time'
+        def check(arg):
+            if time.time() > self.expires:
+                raise Deadline()
+            return func(arg)
+        return check
+
+    def set_limits(self, maxhypotheses=None, deadline=None, oncutoff=None):
+        self.maxhypotheses = maxhypotheses
+        self.deadline = deadline
+        self.oncutoff = oncutoff
+        self.instrument(self.profiler)
+
+    def instrument(self, profiler):
+        'Record steps in StageProfiler, None disables'
+        self.profiler = profiler
+        if self.deadline is None:
+            self.runners = [self.runner(kind, func) for stage, kind, func, stagestr in self.steps]
+        else:
+            self.runners = [self.runner(kind, func if kind == 'return' else self.checked(func)) for stage, kind, func, stagestr in self.steps]
+        self.counters = None
+        if profiler is not None:
+            self.runners = [profiler.wrap(i, stage, stagestr, runner) for i, ((stage, kind, func, stagestr), runner) in enumerate(zip(self.steps, self.runners))]
+            self.counters = [profiler.record(i, stage, stagestr) for i, (stage, kind, func, stagestr) in enumerate(self.steps)]
+
+    def run(self, word, debug=False):
+        'word -> (stage, [Gloss])'
+        stage = -1
+        parsedword = [nullgloss(word)]
+        maxhypotheses = self.maxhypotheses
+        deadline = self.deadline
+        start = time.time()
+        if deadline is not None:
+            self.expires = start + deadline
+        cutoff = False
+        for i, (step, kind, func, stagestr) in enumerate(self.steps):
+            try:
+                produced = self.runners[i](parsedword)
+            except Deadline:
+                self.cutoff(word, i, 'deadline', len(parsedword), start)
+                return (cutoff_stage(stage), [p for p in parsedword if parsed(p)] or parsedword)
+            self.produced[i] += len(produced)
+            if kind == 'return':
+                if produced:
+                    result = unique(produced)
+                    self.kept[i] += len(result)
+                    if self.counters:
+                        self.counters[i][6] += len(result)
+                    return (cutoff_stage(stage) if cutoff else stage, result)
+            else:
+                newparsed = unique(produced)
+                if maxhypotheses is not None and len(newparsed) > maxhypotheses:
+                    self.cutoff(word, i, 'hypotheses', len(newparsed), start)
+                    newparsed = keep_best(newparsed, maxhypotheses)
+                    cutoff = True
+                self.kept[i] += len(newparsed)
+                if self.counters:
+                    self.counters[i][6] += len(newparsed)
+                # compared before deduplication, as results with and
+                # without duplicates differ on the same steps
+                if not produced == parsedword:
+                    stage = step
+                    parsedword = newparsed
+                if debug:
+                    print stagestr
+                    print stage, '\n'.join(unicode(p) for p in produced)
+        return (cutoff_stage(stage) if cutoff else stage, parsedword)
+
+    def cutoff(self, word, i, reason, hypotheses, start):
+        'Count and report a limit hit before or at step i'
+        self.cutoffs[i] += 1
+        if self.oncutoff is not None:
+            stage, kind, func, stagestr = self.steps[i]
+            self.oncutoff(OrderedDict([
+                ('word', word),
+                ('reason', reason),
+                ('index', i),
+                ('step', unicode(stage)),
+                ('stage', u' '.join(stagestr) if isinstance(stagestr, (list, tuple)) else stagestr),
+                ('hypotheses', hypotheses),
+                ('seconds', time.time() - start),
+                ]))
+
+    def stats(self):
+        return [OrderedDict([
+            ('index', i),
+            ('step', unicode(stage)),
+            ('stage', u' '.join(stagestr) if isinstance(stagestr, (list, tuple)) else stagestr),
+            ('produced', self.produced[i]),
+            ('kept', self.kept[i]),
+            ('cutoffs', self.cutoffs[i]),
+            ]) for i, (stage, kind, func, stagestr) in enumerate(self.steps)]
+
+
 class Parser(object):
+    # cap on composite splits tried per stem by decompose, None for all
+    maxsplits = None
+
     def __init__(self, dictionary, grammar, detone=False):
         'Dictionary, Grammar, str -> Parser'
         self.dictionary = dictionary
@@ -121,23 +726,48 @@ class Parser(object):
                 'parse': self.parse,
                 'decompose': self.decompose
                 }
-        self.processing = []
         self.detone = detone
+        # results are interned, None to keep them as built
+        self.pool = glosspool
+        self.profiler = None
+        self.grammar = grammar
+        self.plan = CompiledPlan(self.compile(grammar))
+
+    def compile(self, grammar):
+        'Grammar -> [(stage, kind, func, stagestr)] steps of CompiledPlan'
         if grammar is None:
-            self.processing.append((0, f_apply(self.lookup), ('apply', 'lookup')))
-        else:
-            self.grammar = grammar
-            for step in self.grammar.plan['token']:
-                if step[0] == 'return':
-                    self.processing.append((step[0], lambda l: filter(self.funcdict[step[1]], l), step[1]))
-                else:
-                    funclist = []
-                    for f in step[1]:
-                        try:
-                            funclist.append(self.funcdict[f])
-                        except KeyError:
-                            funclist.append(self.grammar.patterns[f])
-                    self.processing.append((step[0], funclist[0](*funclist[1:]), step[1]))
+            return [(0, 'apply', self.lookup, ('apply', 'lookup'))]
+        steps = []
+        for step in grammar.plan['token']:
+            if step[0] == 'return':
+                steps.append((step[0], 'return', self.funcdict[step[1]], step[1]))
+                continue
+            funclist = []
+            for f in step[1]:
+                try:
+                    funclist.append(self.funcdict[f])
+                except KeyError:
+                    patterns = grammar.patterns[f]
+                    if funclist and funclist[-1] == self.parse:
+                        patterns = PatternIndex(patterns)
+                    funclist.append(patterns)
+            if step[1][0] in ['add', 'apply']:
+                # same as f_add or f_apply, without wrapping closures
+                func = funclist[1](*funclist[2:]) if len(funclist) > 2 else funclist[1]
+                patterns = self.profiler.patterns if self.profiler is not None else None
+                if patterns is not None:
+                    if len(funclist) == 4 and funclist[1] in [parallel, sequential, firstmatch]:
+                        func = patterns.combine(step[1][3], funclist[1], step[1][2], funclist[2], funclist[3])
+                    func = patterns.trace(func)
+                steps.append((step[0], step[1][0], func, step[1]))
+            else:
+                steps.append((step[0], 'call', funclist[0](*funclist[1:]), step[1]))
+        return steps
+
+    @property
+    def processing(self):
+        '[(stage, [Gloss] -> [Gloss], stagestr)]'
+        return [(stage, runner, stagestr) for (stage, kind, func, stagestr), runner in zip(self.plan.steps, self.plan.runners)]
 
     def lookup_gloss(self, gloss, gdict):
         'Gloss, Dictionary -> tuple(Gloss)'
@@ -253,7 +883,7 @@ class Parser(object):
                             decomp = [[emptyGloss._replace(form=f) for f in re.split(splitre, stem)]]
                             break
                 else:
-                    decomp = [[emptyGloss._replace(form=f) for f in fl] for fl in parse_composite(stem, self.dictionary, parts)]
+                    decomp = [[emptyGloss._replace(form=f) for f in fl] for fl in parse_composite(stem, self.dictionary, parts, self.maxsplits)]
                 if decomp:
                     morphmatches = [tuple(m.matches(p) for m,p in zip(gl, pattern.select.morphemes)) for gl in decomp]
                     newmorphemes = [tuple(m.union(p) for m,p in zip(gl, pattern.select.morphemes)) for gl in decomp]
@@ -274,29 +904,60 @@ class Parser(object):
         return None
 
     def filter_duplicates(self, seq):
-        seen = set()
-        seen_add = seen.add
-        return [x for x in seq if not (x in seen or seen_add(x))]
+        return unique(seq)
+
+    def set_profiler(self, profiler):
+        'Record per-stage statistics in StageProfiler, None disables'
+        recompile = any(p is not None and p.patterns is not None for p in [self.profiler, profiler])
+        if self.profiler is not None:
+            del self.lemmatize
+        self.profiler = profiler
+        if recompile:
+            # pattern statistics need instrumented step functions
+            plan = self.plan
+            self.plan = CompiledPlan(self.compile(self.grammar))
+            self.plan.set_limits(plan.maxhypotheses, plan.deadline, plan.oncutoff)
+        self.plan.instrument(profiler)
+        if profiler is not None:
+            # instance attribute shadows the method, so that unprofiled
+            # parser pays nothing for instrumentation
+            self.lemmatize = self._lemmatize_profiled
+
+    def _lemmatize_profiled(self, word, debug=False):
+        profiler = self.profiler
+        profiler.last = None
+        if profiler.patterns is not None:
+            profiler.patterns.begin()
+        start = time.time()
+        result = Parser.lemmatize(self, word, debug)
+        profiler.seconds += time.time() - start
+        if profiler.patterns is not None:
+            profiler.patterns.end(result[1])
+        profiler.words += 1
+        if profiler.last is None:
+            profiler.unresolved += 1
+        else:
+            profiler.last[5] += 1
+        return result
+
+    def set_limits(self, maxhypotheses=None, deadline=None, oncutoff=None):
+        'Hypotheses per step and seconds per word, see CompiledPlan'
+        self.plan.set_limits(maxhypotheses, deadline, oncutoff)
 
     def lemmatize(self,word, debug=False):
         'word -> (stage, [Gloss])'
-        stage = -1
-        parsedword = [nullgloss(word)]
-        for step, stageparser, stagestr in self.processing:
-            if step == 'return':
-                filtered = stageparser(parsedword)
-                if filtered:
-                    return (stage, self.filter_duplicates(filtered))
-            else:
-                newparsed = stageparser(parsedword)
-                #FIXME: debug statement
-                if not newparsed == parsedword:
-                    stage = step
-                    parsedword = newparsed
-                if debug:
-                    print stagestr
-                    print stage, '\n'.join(unicode(p) for p in newparsed)
-        return (stage, self.filter_duplicates(parsedword))
+        stage, result = self.plan.run(word, debug)
+        if self.pool is not None:
+            result = [self.pool.intern(g) for g in result]
+        return (stage, result)
+
+    def lemmatize_many(self, forms):
+        '[word] -> {word: (stage, [Gloss])}, each distinct word lemmatized once'
+        result = {}
+        for form in forms:
+            if form not in result:
+                result[form] = self.lemmatize(form)
+        return result
 
     def disambiguate(sent):
         # TODO: STUB
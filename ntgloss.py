@@ -1,7 +1,7 @@
 #/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from contextlib import closing
 import re
 import cPickle
@@ -168,6 +168,70 @@ class Gloss(namedtuple('Gloss', 'form ps gloss morphemes')):
 
 emptyGloss = Gloss('',(),'',())
 
+class GlossPool(object):
+    """ Hash-consing pool of glosses.
+
+    intern(gloss) returns the pooled gloss equal to the given one, so
+    that equal glosses, and equal strings, ps tuples and morphemes
+    inside them, are single shared objects: they take memory once and
+    compare by identity first. Plain (form, ps, gloss, morphemes) tuples
+    are interned as Gloss. The pool is emptied when it reaches maxsize
+    glosses, None for no limit.
+    """
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.glosses = {}
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.glosses)
+
+    def clear(self):
+        self.glosses.clear()
+        self.values.clear()
+
+    def value(self, value):
+        'str or tuple of str -> pooled equal value'
+        if isinstance(value, tuple):
+            value = tuple(self.value(v) for v in value)
+        try:
+            return self.values.setdefault(value, value)
+        except TypeError:
+            return value
+
+    def intern(self, gloss):
+        'Gloss or tuple -> pooled Gloss, None and Gloss subclasses as is'
+        if gloss is None or type(gloss) not in (Gloss, tuple):
+            return gloss
+        try:
+            pooled = self.glosses[gloss]
+            self.hits += 1
+            return pooled
+        except KeyError:
+            pass
+        except TypeError:
+            return gloss
+        self.misses += 1
+        form, ps, gl, morphemes = gloss
+        pooled = Gloss(self.value(form), self.value(ps), self.value(gl), tuple(self.intern(m) for m in morphemes))
+        if self.maxsize and len(self.glosses) >= self.maxsize:
+            self.clear()
+        self.glosses[pooled] = pooled
+        return pooled
+
+    def stats(self):
+        return OrderedDict([
+            ('glosses', len(self.glosses)),
+            ('values', len(self.values)),
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ])
+
+# shared by dictionary lookups, parser results and corpus readers
+glosspool = GlossPool(maxsize=500000)
+
 class Pattern(object):
     def __init__(self, select, mark):
         self.select = select
@@ -353,6 +417,19 @@ class TestObjects(unittest.TestCase):
         self.assertEquals(False, self.pat.matches(self.gam))
         self.assertEquals(unicode(self.gam), unicode(self.pat.apply(self.ga)))
 
+    def test_glosspool(self):
+        pool = GlossPool(maxsize=3)
+        a = pool.intern(self.gam)
+        self.assertEquals(self.gam, a)
+        self.assertTrue(a is pool.intern(Gloss(u'ab', ('n',), 'gloss', self.gam.morphemes)))
+        self.assertTrue(a.ps is a.morphemes[0].ps)
+        t = pool.intern((u'a', ('n',), 'gloss', ()))
+        self.assertTrue(t is a.morphemes[0])
+        self.assertEquals(Gloss, type(t))
+        self.assertEquals(None, pool.intern(None))
+        pool.intern(self.ga)
+        self.assertEquals(1, len(pool))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,9 @@
 #!/usr/bin/python
 # -*- coding: utf8 -*-
 import os,sys
+import re
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from daba.orthography import Syllabify
 
 class PluginMount(type):
@@ -38,10 +39,42 @@ class OrthographyConverter(object):
 
     @convert    Main conversion method. Takes single token as input, returns
     list of possible conversions
+
+    Optionally:
+
+    @lattice    Takes single token, returns list of graphemes, each as a
+    list of alternatives, such that convert returns all their
+    concatenations. Lets the parser skip alternatives not found in
+    dictionaries (see mparser.ConverterChain)
     """
     __metaclass__ = PluginMount
 
 
+TITLE_RE = re.compile(r'''self\.title\s*=\s*['"]([^'"]+)['"]''')
+
+def plugin_titles(plugindir=None):
+    """Titles of available plugins -> module names, found by reading
+    plugin sources, without importing them"""
+    plugindir = plugindir or os.path.dirname(os.path.abspath(__file__))
+    titles = OrderedDict()
+    for f in sorted(os.listdir(plugindir)):
+        if f.endswith('.py') and not f.startswith('__'):
+            with open(os.path.join(plugindir, f)) as src:
+                for title in TITLE_RE.findall(src.read()):
+                    titles[title] = f[:-3]
+    return titles
+
+def load_plugin(title):
+    'Import the module of a single plugin and return plugin instance'
+    module = plugin_titles().get(title)
+    if module is not None:
+        __import__('.'.join([__name__, module]))
+    plugins = OrthographyConverter.get_plugins()
+    if title not in plugins:
+        raise KeyError(u'Unknown orthographic conversion plugin: {0}'.format(title))
+    return plugins[title]
+
+
 class TonesConverter(object):
     def __init__(self, word, debug=False):
         self.debug = debug
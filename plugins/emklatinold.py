@@ -12,9 +12,10 @@ class ManinkaOldtoNew(OrthographyConverter):
         self.title = 'emklatinold'
         self.desc = 'Convertor from old latin Maninka orthography (ambiguous)'
 
-    def convert(self, token):
+    def lattice(self, token):
         """
-        Main conversion method
+        Word as a list of graphemes, each given as a list of its possible
+        spellings in new orthography: convert returns all concatenations
         """
         conversion_table = {
                 u'è':[u'ɛ'], 
@@ -41,6 +42,20 @@ class ManinkaOldtoNew(OrthographyConverter):
             #print 'CW', string, ':', r
             return r
 
+        def convertg(grapheme):
+            # convert a single grapheme into a list of corresponding graphemes in new orthography
+            try:
+                # !!HACK: converts graphemes to lowercase!!
+                return conversion_table[grapheme.lower()]
+            except KeyError:
+                return [grapheme]
+
+        return [convertg(g) for g in graphemes_old(token)]
+
+    def convert(self, token):
+        """
+        Main conversion method
+        """
         def multiply_list(amblist):
             # given list of lists, returns list of all possible concatenations
             # taking a single element from each list
@@ -52,18 +67,5 @@ class ManinkaOldtoNew(OrthographyConverter):
                     return l
             return multiply_list_aux([[]], amblist)
 
-        def convertg(grapheme):
-            # convert a single grapheme into a list of corresponding graphemes in new orthography
-            try:
-                # !!HACK: converts graphemes to lowercase!!
-                return conversion_table[grapheme.lower()]
-            except KeyError:
-                return [grapheme]
-
-        def convertw(word):
-            # given single word in old orthography returns 
-            # list of all possible translations to new orthography
-            graphemes = [convertg(g) for g in graphemes_old(word)]
-            return [''.join(w) for w in multiply_list(graphemes)]
-        
-        return convertw(token)
+        # list of all possible translations to new orthography
+        return [''.join(w) for w in multiply_list(self.lattice(token))]